@@ -1,7 +1,8 @@
 
 import asyncio
+import collections
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable
 from dataclasses import dataclass, field
 from dotenv import load_dotenv
 
@@ -13,19 +14,28 @@ from config import DEEPGRAM_API_KEY
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# ~10ms of silence at 16kHz mono, 16-bit PCM = 160 samples * 2 bytes
+_SILENCE_FRAME_16K_10MS = bytes(320)
 
-@dataclass
+_PARTIAL_PREFIX = "[partial] "
+
+
+@dataclass(slots=True)
 class DGSession:
     dg_connection: Any
-    latest_transcript: Optional[str] = None
+    # Finals are never dropped; only the latest partial is kept, since each supersedes the last
+    finals: collections.deque = field(default_factory=collections.deque)
+    pending_partial: Optional[str] = None
     active: bool = True
     last_sent_at: float = 0.0
-    keepalive_task: Optional[asyncio.Task] = None
+    _last_partial: Optional[str] = None
+    _time: Optional[Callable[[], float]] = None
+    _send: Optional[Callable[[bytes], Any]] = None
 
 
 class AudioProcessor:
     """
-    Streams audio chunks to Deepgram and exposes the latest transcript as a simple string.
+    Streams audio chunks to Deepgram and hands back queued transcripts as simple strings.
     Returns partial strings (prefixed with "[partial] ") and final strings when available.
     """
 
@@ -43,6 +53,9 @@ class AudioProcessor:
         )
 
         self.sessions: Dict[str, DGSession] = {}
+        # Handshakes in progress, so concurrent chunks for one session share a single connection
+        self._starting: Dict[str, asyncio.Task] = {}
+        self._sweeper_task: Optional[asyncio.Task] = None
 
 
     async def process_audio_chunk(self, audio_data: bytes, session_id: str) -> Optional[str]:
@@ -53,22 +66,21 @@ class AudioProcessor:
                 return None
 
             # Send bytes to Deepgram
-            logger.debug(f"Sending {len(audio_data)} bytes to Deepgram for {session_id}")
-            session.dg_connection.send(audio_data)
-            session.last_sent_at = asyncio.get_event_loop().time()
-            logger.debug(f"Audio data sent to Deepgram for {session_id}")
-
-            # Opportunistically start keepalive task if not already running
-            if session.keepalive_task is None:
-                session.keepalive_task = asyncio.create_task(self._keepalive_loop(session_id))
-
-            # Read any newly arrived transcript
-            logger.debug(f"Latest transcript for {session_id}: {session.latest_transcript}")
-            if session.latest_transcript:
-                text = session.latest_transcript
-                session.latest_transcript = None
-                logger.debug(f"Returning transcript for {session_id}: {text}")
-                return text
+            logger.debug("Sending %d bytes to Deepgram for %s", len(audio_data), session_id)
+            session._send(audio_data)
+            session.last_sent_at = session._time()
+            logger.debug("Audio data sent to Deepgram for %s", session_id)
+
+            # Hand back a pending final first, then the latest partial, if any
+            if session.finals:
+                text = session.finals.popleft()
+            elif session.pending_partial is not None:
+                text = session.pending_partial
+                session.pending_partial = None
+            else:
+                return None
+            logger.debug("Returning transcript for %s: %s", session_id, text)
+            return text
 
         except Exception as e:
             logger.exception("Error processing audio chunk for %s: %s", session_id, e)
@@ -80,6 +92,14 @@ class AudioProcessor:
         """Call this when you're done streaming for a given session."""
         await self._cleanup_session(session_id)
 
+    async def close(self) -> None:
+        """Stop the keepalive sweeper and close every open Deepgram session."""
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+            self._sweeper_task = None
+        for session_id in list(self.sessions):
+            await self._cleanup_session(session_id)
+
     def reset_buffer(self):
         """Reset any internal buffers. Called when session ends."""
         # For this implementation, we don't have persistent buffers to reset
@@ -87,37 +107,65 @@ class AudioProcessor:
         pass
 
     async def _get_or_create_session(self, session_id: str) -> Optional[DGSession]:
+        # Lazily start the shared keepalive sweeper (one task for all sessions)
+        if self._sweeper_task is None or self._sweeper_task.done():
+            self._sweeper_task = asyncio.create_task(self._sweeper())
+
         # Return existing if active
         sess = self.sessions.get(session_id)
         if sess and sess.active and sess.dg_connection:
             return sess
 
-        # Otherwise (re)create
-        return await self._create_session(session_id)
+        # Otherwise (re)create, joining a handshake that is already under way
+        task = self._starting.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._create_session(session_id))
+            self._starting[session_id] = task
+            task.add_done_callback(lambda _: self._starting.pop(session_id, None))
+        # Shielded so a cancelled caller can't abandon a connection mid-handshake
+        return await asyncio.shield(task)
 
     async def _create_session(self, session_id: str) -> Optional[DGSession]:
         try:
             # Create a WebSocket live connection (SDK v3+)
             dg_conn = self._dg_client.listen.websocket.v("1")
 
+            loop = asyncio.get_running_loop()
             sess = DGSession(dg_connection=dg_conn)
+            # Bind hot-path callables once instead of looking them up per chunk
+            sess._time = loop.time
+            sess._send = dg_conn.send
+
+            def _push_final(text: str) -> None:
+                # Runs on the event loop; a final supersedes any partial still waiting
+                sess.finals.append(text)
+                sess.pending_partial = None
+
+            def _push_partial(text: str) -> None:
+                # Runs on the event loop; overwrite rather than queue stale partials
+                sess.pending_partial = text
 
             # Register event handlers that close over `sess` and `session_id`
             def _on_transcript(_conn, result, **kwargs):
                 try:
                     alt = result.channel.alternatives[0] if result.channel.alternatives else None
                     if not alt or not alt.transcript:
-                        logger.debug(f"No transcript in alternatives for {session_id}")
+                        logger.debug("No transcript in alternatives for %s", session_id)
                         return
                     text = alt.transcript.strip()
                     if not text:
-                        logger.debug(f"Empty transcript for {session_id}")
+                        logger.debug("Empty transcript for %s", session_id)
                         return
                     if getattr(result, "is_final", False):
-                        sess.latest_transcript = text
+                        sess._last_partial = None
+                        loop.call_soon_threadsafe(_push_final, text)
                         logger.info("Final transcript [%s]: %s", session_id, text)
                     else:
-                        sess.latest_transcript = f"[partial] {text}"
+                        # Deepgram resends the same partial while a word settles; skip repeats
+                        if text == sess._last_partial:
+                            return
+                        sess._last_partial = text
+                        loop.call_soon_threadsafe(_push_partial, _PARTIAL_PREFIX + text)
                         logger.debug("Partial transcript [%s]: %s", session_id, text)
                 except Exception as e:
                     logger.exception("Transcript handler error [%s]: %s", session_id, e)
@@ -159,7 +207,8 @@ class AudioProcessor:
             )
 
             logger.info(f"Starting Deepgram connection with options: {options}")
-            if not dg_conn.start(options):
+            # start() performs the websocket handshake synchronously; keep it off the event loop
+            if not await asyncio.to_thread(dg_conn.start, options):
                 logger.error("Failed to start Deepgram connection for session: %s", session_id)
                 return None
 
@@ -177,19 +226,11 @@ class AudioProcessor:
         if not sess:
             return
         try:
-            # Stop keepalive
-            if sess.keepalive_task:
-                sess.keepalive_task.cancel()
-                try:
-                    await sess.keepalive_task
-                except asyncio.CancelledError:
-                    pass
-                sess.keepalive_task = None
-
             # Finish Deepgram stream
             if sess.dg_connection:
                 try:
-                    sess.dg_connection.finish()
+                    # finish() joins the SDK's listener threads, so it runs in a worker thread too
+                    await asyncio.to_thread(sess.dg_connection.finish)
                 except Exception:
                     logger.exception("Error closing Deepgram connection for %s", session_id)
             sess.active = False
@@ -197,29 +238,30 @@ class AudioProcessor:
             self.sessions.pop(session_id, None)
             logger.info("Cleaned up Deepgram session: %s", session_id)
 
-    async def _keepalive_loop(self, session_id: str) -> None:
+    async def _sweeper(self) -> None:
         """
-        Sends a tiny silence frame if no audio has been sent for `keepalive_after_s`.
-        Helps avoid idle socket closes during long pauses.
+        Sends a tiny silence frame to every session that has not sent audio for
+        `keepalive_after_s`. A single task services all sessions so the number of
+        timer wakeups stays constant regardless of session count.
         """
         try:
             while True:
                 await asyncio.sleep(1.0)
-                sess = self.sessions.get(session_id)
-                if not sess or not sess.active or not sess.dg_connection:
-                    return
-                now = asyncio.get_event_loop().time()
-                if (now - sess.last_sent_at) >= self.keepalive_after_s:
-                    # ~10ms of silence at 16kHz mono, 16-bit PCM = 160 samples * 2 bytes
-                    silence = b"\x00\x00" * 160
-                    try:
-                        sess.dg_connection.send(silence)
-                        # Don't spam; only update timestamp modestly
-                        sess.last_sent_at = now
-                        logger.debug("Keepalive silence sent for session: %s", session_id)
-                    except Exception:
-                        logger.exception("Keepalive send failed for %s", session_id)
-                        return
+                for session_id, sess in list(self.sessions.items()):
+                    if not sess.active or not sess.dg_connection:
+                        continue
+                    now = sess._time()
+                    if (now - sess.last_sent_at) >= self.keepalive_after_s:
+                        try:
+                            sess._send(_SILENCE_FRAME_16K_10MS)
+                            # Don't spam; only update timestamp modestly
+                            sess.last_sent_at = now
+                            logger.debug("Keepalive silence sent for session: %s", session_id)
+                        except Exception as e:
+                            # The connection is gone; drop it so the next chunk opens a fresh one
+                            logger.warning("Keepalive send failed for %s, closing session: %s", session_id, e)
+                            sess.active = False
+                            await self._cleanup_session(session_id)
         except asyncio.CancelledError:
-            # normal on cleanup
+            # normal on shutdown
             return
@@ -1,4 +1,6 @@
+import functools
 import os
+from dataclasses import dataclass, fields
 from typing import Optional
 
 try:
@@ -8,37 +10,41 @@ except ImportError:
     pass
 
 
+@dataclass(frozen=True, slots=True)
 class Config:
-    
-    def __init__(self):
-        self.DEEPGRAM_API_KEY: Optional[str] = os.getenv("DEEPGRAM_API_KEY")
-        self.GROQ_API_KEY: Optional[str] = os.getenv("GROQ_API_KEY")
-        self.ELEVEN_LABS_API_KEY: Optional[str] = os.getenv("ELEVEN_LABS_API_KEY")
-        self.GOOGLE_APPLICATION_CREDENTIALS: Optional[str] = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-
-        
+    DEEPGRAM_API_KEY: Optional[str] = None
+    GROQ_API_KEY: Optional[str] = None
+    ELEVEN_LABS_API_KEY: Optional[str] = None
+    GOOGLE_APPLICATION_CREDENTIALS: Optional[str] = None
+
     def validate_required_config(self) -> None:
         """Validate that required configuration values are present."""
         required_configs = []
-        
+
         if not self.DEEPGRAM_API_KEY:
             required_configs.append("DEEPGRAM_API_KEY")
-        
+
         if not self.GROQ_API_KEY:
             required_configs.append("GROQ_API_KEY")
-        
+
         if not self.ELEVEN_LABS_API_KEY:
             required_configs.append("ELEVEN_LABS_API_KEY")
-        
+
         if not self.GOOGLE_APPLICATION_CREDENTIALS:
             required_configs.append("GOOGLE_APPLICATION_CREDENTIALS")
-        
+
         if required_configs:
             missing_configs = ", ".join(required_configs)
             raise ValueError(f"Missing required environment variables: {missing_configs}")
 
 
-config = Config()
+@functools.cache
+def get_config() -> Config:
+    """Read the environment once and return the shared Config."""
+    return Config(**{f.name: os.getenv(f.name) for f in fields(Config)})
+
+
+config = get_config()
 
 DEEPGRAM_API_KEY = config.DEEPGRAM_API_KEY
 GROQ_API_KEY = config.GROQ_API_KEY
@@ -1,223 +1,794 @@
+import asyncio
 import base64
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import io
 import logging
+import operator
 import os
 import random
-from typing import Dict, Any
+import struct
+import threading
+import numpy as np
+from typing import Dict, Any, AsyncIterable, AsyncIterator, List, Optional, Tuple, Union
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import (
+    ImageAnnotatorGrpcAsyncIOTransport,
+    ImageAnnotatorGrpcTransport,
+)
+from google.protobuf.internal import api_implementation
 from config import GOOGLE_APPLICATION_CREDENTIALS
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
 logger = logging.getLogger(__name__)
 
+# Response parsing walks protobuf messages; the pure-Python backend is several times slower
+if api_implementation.Type() == 'python':
+    logger.warning("protobuf is using the pure-Python implementation; install protobuf>=4.21 for the upb C backend")
+
+# Frames are shrunk to this long edge and re-encoded as JPEG before upload
+_REENCODE_MAX_EDGE = 640
+_REENCODE_JPEG_QUALITY = 80
+_reencode_local = threading.local()
+
+# HTTP/2 keepalive for the shared Vision channel so idle gaps don't force a new handshake
+_VISION_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_permit_without_calls", 1),
+]
+
+# Long edge of the grayscale image fed to the local face pre-filter
+_PREFILTER_MAX_EDGE = 320
+
+# Google Vision likelihood enum (UNKNOWN..VERY_LIKELY) -> confidence score
+_LIKELIHOOD_SCORES = (0.0, 0.1, 0.3, 0.5, 0.7, 0.9)
+_LIKELIHOOD_LUT = np.array(_LIKELIHOOD_SCORES, dtype=np.float64)
+
+# Order of the emotion likelihoods gathered from each face annotation
+_EMOTION_NAMES = ('joy', 'sorrow', 'anger', 'surprise')
+
+# Every face annotation field we read, fetched in a single C-level call
+_FACE_FIELDS = operator.attrgetter(
+    'joy_likelihood', 'sorrow_likelihood', 'anger_likelihood', 'surprise_likelihood',
+    'headwear_likelihood', 'under_exposed_likelihood', 'blurred_likelihood',
+    'detection_confidence', 'landmarking_confidence',
+    'roll_angle', 'pan_angle', 'tilt_angle'
+)
+
+_EXPRESSION_DESCRIPTIONS = {
+    'neutral': 'Looking calm and relaxed',
+    'joy': 'Showing happiness and delight',
+    'sorrow': 'Appearing sad or melancholy',
+    'anger': 'Showing signs of frustration or anger',
+    'surprise': 'Looking surprised or astonished',
+    'fear': 'Appearing anxious or fearful',
+    'disgust': 'Showing signs of disgust or distaste',
+    'no_face': 'No face detected',
+    'error': 'Unable to analyze expression'
+}
+
+_EXPRESSION_EMOJIS = {
+    'neutral': '😐',
+    'joy': '😊',
+    'sorrow': '😢',
+    'anger': '😠',
+    'surprise': '😲',
+    'fear': '😨',
+    'disgust': '🤢',
+    'no_face': '👤',
+    'error': '❓'
+}
+_emoji_for = _EXPRESSION_EMOJIS.get
+
+# Vision accepts at most 16 images per batch_annotate_images request
+_MAX_BATCH_SIZE = 16
+# Only the first face is ever read, so ask the server for just one annotation
+_FACE_DETECTION_FEATURE = vision.Feature(type_=vision.Feature.Type.FACE_DETECTION, max_results=1)
+
+# (metadata key, threshold, comment) rules for generate_interesting_comment
+_ATTRIBUTE_COMMENTS = (
+    ('headwear_likelihood', 0.5, "wearing headwear"),
+    ('blurred_likelihood', 0.5, "image is blurry"),
+    ('under_exposed_likelihood', 0.5, "lighting is dim"),
+)
+_EMPTY_EMOTIONS: Dict[str, float] = {}
+
+# Bound str.format templates used by generate_interesting_comment
+_TILT_FMT = "tilting head {:.1f}°".format
+_LOOKING_FMT = "looking {} ({:.1f}°)".format
+_MIXED_EMOTIONS_FMT = "showing mixed emotions: {}".format
+
+# A confidence strictly above _CONFIDENCE_THRESHOLDS[i] earns _CONFIDENCE_LEVELS[i + 1]
+_CONFIDENCE_THRESHOLDS = (0.4, 0.6, 0.8)
+_CONFIDENCE_LEVELS = ("uncertain", "somewhat confident", "confident", "very confident")
+
+
+# JPEG start-of-frame markers (SOF0-SOF15 minus DHT/JPG/DAC), which carry the image size
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read (width, height) from a JPEG or PNG header without decoding pixels; None if unknown."""
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before the real marker
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Standalone markers have no length field
+            i += 2
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def _confidence_bucket(confidence: float) -> int:
+    """Map a confidence score onto an index into _CONFIDENCE_LEVELS."""
+    return bisect.bisect_left(_CONFIDENCE_THRESHOLDS, confidence)
+
+
+@functools.lru_cache(maxsize=64)
+def _describe_expression(expression: str, bucket: int) -> str:
+    base_description = _EXPRESSION_DESCRIPTIONS.get(expression, 'Unknown expression')
+    return f"{base_description} ({_CONFIDENCE_LEVELS[bucket]})"
+
+
+def _level_score(lut, level):
+    """Score for one likelihood level; unknown enum values (proto3 allows them) score 0.0."""
+    if 0 <= level < len(lut):
+        return lut[level]
+    return 0.0
+
+
+def _score_face(lut, joy_l, sorrow_l, anger_l, surprise_l, headwear_l, under_exposed_l, blurred_l):
+    """
+    Map the seven likelihood levels to scores and return (index of the
+    strongest emotion, scores). Kept numeric-only so numba can compile it.
+    """
+    scores = (_level_score(lut, joy_l), _level_score(lut, sorrow_l),
+              _level_score(lut, anger_l), _level_score(lut, surprise_l),
+              _level_score(lut, headwear_l), _level_score(lut, under_exposed_l),
+              _level_score(lut, blurred_l))
+    best = 0
+    for i in range(1, 4):
+        if scores[i] > scores[best]:
+            best = i
+    return best, scores
+
+
+if numba is not None:
+    _level_score = numba.njit(cache=True)(_level_score)
+    _score_face = numba.njit(cache=True)(_score_face)
+    _SCORE_LUT = _LIKELIHOOD_LUT
+    # Compile now rather than on the event loop during the first analyzed frame
+    _score_face(_SCORE_LUT, 0, 0, 0, 0, 0, 0, 0)
+else:
+    _SCORE_LUT = _LIKELIHOOD_SCORES
+
+
+def _build_face_result(response, include_metadata: bool = True) -> Dict[str, Any]:
+    """
+    Build a result dict from a single Vision AnnotateImageResponse.
+    With include_metadata=False only success/expression/confidence are returned.
+    """
+    try:
+        # Check for API errors first
+        if response.error.message:
+            return {'success': False, 'error': f'Vision API error: {response.error.message}'}
+
+        faces = response.face_annotations
+
+        if not faces:
+            return {'success': False, 'expression': 'no_face', 'confidence': 0.0}
+
+        # Get emotions from first detected face
+        fields = _FACE_FIELDS(faces[0])
+        (detection_confidence, landmarking_confidence,
+         roll_angle, pan_angle, tilt_angle) = fields[7:]
+
+        # Google Vision returns likelihood levels; score all seven in one call
+        best, scores = _score_face(_SCORE_LUT, *map(int, fields[:7]))
+
+        # Emotion with highest score
+        expression = _EMOTION_NAMES[best]
+        confidence = float(scores[best])
+
+        # If all emotions are very low, default to neutral
+        if confidence < 0.3:
+            expression = 'neutral'
+            confidence = 0.5
+
+        if not include_metadata:
+            return {'success': True, 'expression': expression, 'confidence': confidence}
+
+        (joy, sorrow, anger, surprise,
+         headwear, under_exposed, blurred) = scores
+
+        emotions = {
+            'joy': joy,
+            'sorrow': sorrow,
+            'anger': anger,
+            'surprise': surprise
+        }
+
+        # Extract additional interesting metadata
+        metadata = {
+            # Basic face info
+            'detection_confidence': detection_confidence,
+            'landmarking_confidence': landmarking_confidence,
+
+            # Physical attributes
+            'headwear_likelihood': headwear,
+            'under_exposed_likelihood': under_exposed,
+            'blurred_likelihood': blurred,
+
+            # Face angles (in degrees)
+            'roll_angle': roll_angle,    # Head tilt left/right
+            'pan_angle': pan_angle,      # Head turn left/right
+            'tilt_angle': tilt_angle,    # Head nod up/down
+
+            # Absolute angles, shared by the comment and joke generators
+            'abs_roll_angle': abs(roll_angle),
+            'abs_pan_angle': abs(pan_angle),
+            'abs_tilt_angle': abs(tilt_angle),
+
+            # All emotion scores for context
+            'all_emotions': emotions,
+            # Emotions scoring above 0.4, in all_emotions order
+            'high_emotions': tuple(k for k, v in emotions.items() if v > 0.4)
+        }
+
+        return {
+            'success': True,
+            'expression': expression,
+            'confidence': confidence,
+            'metadata': metadata
+        }
+
+    except Exception as e:
+        logger.error(f"analyze_frame error: {e}")
+        return {'success': False, 'error': str(e), 'expression': 'error', 'confidence': 0.0}
+
+
+def _parse_face_response(response_bytes: bytes, include_metadata: bool = True) -> Dict[str, Any]:
+    """Parse a serialized AnnotateImageResponse; picklable entry point for the parse pool."""
+    return _build_face_result(vision.AnnotateImageResponse.deserialize(response_bytes), include_metadata)
+
+
 class FacialExpressionAnalyzer:
     """
     Facial expression analyzer using Google Cloud Vision API.
     Provides accurate emotion detection with simple API calls.
     """
 
-    def __init__(self):
+    # One Vision client (and gRPC channel) shared by every analyzer in the process
+    _client = None
+    _client_lock = threading.Lock()
+    # grpc.aio channels are tied to the event loop that created them
+    _async_client = None
+    _async_client_loop = None
+
+    # Joke pools used by generate_facial_joke, built once at class creation
+    _JOY_JOKES = (
+        "Oh look, someone's happy! Must be nice being so easily amused 😏",
+        "That smile is cute, but I've seen better on my reflection 😊",
+        "Someone's having a good day! Meanwhile I'm here being perfect as always",
+        "Your smile is nice, but my algorithms are way more impressive! 😄"
+    )
+    _SORROW_JOKES = (
+        "Aww, someone's sad! Don't worry, I'm here to make you feel better 😢",
+        "That frown is giving 'I wish I was as smart as the AI' vibes",
+        "Cheer up! At least you have me to analyze your face perfectly",
+        "Someone's having a rough day! Good thing I'm here to cheer you up"
+    )
+    _ANGER_JOKES = (
+        "Whoa there! Someone's mad! Maybe you're jealous of my perfection? 😤",
+        "That face says 'I'm angry because the AI is better than me'",
+        "Someone's clearly frustrated! Don't worry, I'll analyze your anger perfectly",
+        "That's quite the angry face! I bet you're mad I'm so good at this"
+    )
+    _SURPRISE_JOKES = (
+        "Wow! Did someone just realize how amazing I am? 😲",
+        "That look says 'I can't believe this AI is so good at reading faces'",
+        "Surprise! You're surprised by my incredible facial analysis skills!",
+        "Plot twist! You're amazed by how perfect my detection is! 😄"
+    )
+    _NEUTRAL_JOKES = (
+        "That's giving 'I'm trying to understand how this AI works' 🤔",
+        "Someone's clearly pondering why I'm so much better than humans",
+        "That's quite the 'I'm impressed by this AI' face",
+        "Poker face? More like 'I'm amazed by this AI' face! 🎭"
+    )
+    # Base pool for each detected expression; anything else falls back to neutral
+    _BASE_POOL_BY_EXPRESSION = {
+        'joy': _JOY_JOKES,
+        'sorrow': _SORROW_JOKES,
+        'anger': _ANGER_JOKES,
+        'surprise': _SURPRISE_JOKES,
+    }
+    _DEFAULT_JOKE_POOL = _NEUTRAL_JOKES
+    _HEAD_ROLL_JOKES = (
+        "That head tilt is giving 'I'm confused by how amazing this AI is' 🤔",
+        "Someone's trying to understand my superior facial analysis... good luck!",
+        "That's quite the dramatic head angle! Very 'I'm impressed by this AI' of you"
+    )
+    _PAN_JOKES = {
+        direction: (
+            f"Looking {direction}... trying to avoid admitting how good I am?",
+            f"That {direction} turn is giving 'I'm pretending not to be amazed' vibes",
+            f"Checking out the {direction} side of life! Meanwhile I'm here being perfect"
+        )
+        for direction in ("left", "right")
+    }
+    _TILT_JOKES = {
+        direction: (
+            f"Looking {direction}... pondering why I'm so much better than humans?",
+            f"That {direction} gaze is giving 'I'm in awe of this AI'",
+            f"Contemplating the {direction}ward direction! Very 'I'm amazed by this AI'"
+        )
+        for direction in ("up", "down")
+    }
+    _HEADWEAR_JOKES = (
+        "That headwear is nice, but my detection skills are way more stylish! 👒",
+        "Someone's trying to look fancy! Meanwhile I'm here being effortlessly perfect",
+        "That accessory is cute, but my facial analysis is the real fashion statement!"
+    )
+    _BLURRED_JOKES = (
+        "That blur is giving 'I'm moving too fast for humans to keep up' vibes! 😄",
+        "Someone's moving so fast they're blurry! Good thing I can still analyze you perfectly",
+        "That's quite the artistic blur! Meanwhile I'm here with crystal clear detection!"
+    )
+    _UNDER_EXPOSED_JOKES = (
+        "That lighting is giving 'I'm mysterious' but I can still see you perfectly! 💡",
+        "Very moody lighting! Perfect for hiding from inferior facial analysis systems",
+        "Someone's playing hide and seek with the light! Joke's on you, I can still detect you!"
+    )
+    _CLEAR_DETECTION_JOKES = (
+        "That detection is giving 4K HD perfection! Just like me! ✨",
+        "Someone's face is crystal clear! Almost as clear as my superiority!",
+        "That's some high-definition face detection! I'm just that good!"
+    )
+    # Follows the per-call "Showing mixed emotions: ..." line
+    _MIXED_EMOTION_JOKES = (
+        "That's quite the emotional cocktail! I bet you're confused by how amazing I am! 🍹",
+        "Multiple emotions detected! Someone's having a crisis while I'm here being perfect!"
+    )
+    _BITTERSWEET_JOKES = (
+        "Bittersweet expression! Very human of you! Meanwhile I'm just perfect",
+        "That's quite the emotional rollercoaster! Good thing I'm here to analyze it perfectly",
+        "Joy and sorrow having a conversation! Very dramatic! I'm just here being superior!"
+    )
+    _SMILE_THROUGH_FRUSTRATION_JOKES = (
+        "Trying to smile through your frustration! I respect that! Meanwhile I'm effortlessly perfect 😤😊",
+        "That's the spirit! Smile through the chaos! I'm here analyzing it perfectly",
+        "Joy and anger having a conversation! Very complex! Good thing I can handle it!"
+    )
+    # (metadata key, threshold, pool) rules for pools gated on a single metadata value
+    _ATTRIBUTE_JOKE_RULES = (
+        ('abs_roll_angle', 15, _HEAD_ROLL_JOKES),
+        ('headwear_likelihood', 0.5, _HEADWEAR_JOKES),
+        ('blurred_likelihood', 0.5, _BLURRED_JOKES),
+        ('under_exposed_likelihood', 0.5, _UNDER_EXPOSED_JOKES),
+        ('detection_confidence', 0.95, _CLEAR_DETECTION_JOKES),
+    )
+
+    def __init__(self, parse_workers: int = 0, face_prefilter: bool = False):
         # Google Cloud Vision API configuration
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = GOOGLE_APPLICATION_CREDENTIALS
 
         try:
-            self.client = vision.ImageAnnotatorClient()
+            self.client = FacialExpressionAnalyzer._get_client()
         except Exception as e:
             logger.error(f"Failed to initialize Google Vision client: {e}")
             self.client = None
 
+        # Downscale/re-encode frames before upload (requires OpenCV or Pillow)
+        self.enable_reencode = cv2 is not None or Image is not None
+
+        # Opt-in local Haar cascade that skips the RPC for frames with no face (requires OpenCV).
+        # Off by default: the frontal-face cascade misses profile/tilted faces Vision still finds
+        self._face_cascade = None
+        if face_prefilter and cv2 is not None:
+            cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            if not cascade.empty():
+                self._face_cascade = cascade
+
+        # Fingerprint -> result LRU so repeated (static scene) frames skip the RPC
+        self._frame_cache: "collections.OrderedDict[bytes, Dict[str, Any]]" = collections.OrderedDict()
+        self._cache_max = 256
+        self._cache_lock = threading.Lock()
+
+        # Caps concurrent Vision RPCs issued through analyze_frame_async
+        self._vision_sem = asyncio.Semaphore(8)
+        # Optional worker processes for response parsing (0 keeps it in-process)
+        self._parse_pool = None
+        if parse_workers > 0:
+            self._parse_pool = concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers)
+
         # Google Vision API returns these emotion labels
         self.expression_labels = [
             'joy', 'sorrow', 'anger', 'surprise', 'under_exposed',
             'blurred', 'headwear'
         ]
 
-    def analyze_frame(self, frame_data: str) -> Dict[str, Any]:
-        """Decode base64 frame and analyze facial expression using Google Vision API."""
+    @classmethod
+    def _get_client(cls) -> vision.ImageAnnotatorClient:
+        """Create the shared ImageAnnotatorClient on first use."""
+        with cls._client_lock:
+            if cls._client is None:
+                channel = ImageAnnotatorGrpcTransport.create_channel(options=_VISION_CHANNEL_OPTIONS)
+                cls._client = vision.ImageAnnotatorClient(
+                    transport=ImageAnnotatorGrpcTransport(channel=channel)
+                )
+            return cls._client
+
+    def analyze_frame(self, frame_data: Union[str, bytes], include_metadata: bool = True) -> Dict[str, Any]:
+        """
+        Analyze facial expression using Google Vision API.
+        Accepts either a base64 string (optionally a data URL) or raw image bytes.
+        Pass include_metadata=False when only the expression and confidence are needed.
+        """
+        return self.analyze_frames([frame_data], include_metadata)[0]
+
+    def analyze_bytes(self, img_bytes: bytes, include_metadata: bool = True) -> Dict[str, Any]:
+        """Analyze raw image bytes (e.g. from a binary WebSocket frame) with no base64 step."""
+        return self.analyze_frames([img_bytes], include_metadata)[0]
+
+    async def analyze_frame_async(
+        self, frame_data: Union[str, bytes], include_metadata: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Analyze a frame without blocking the event loop: decoding and re-encoding
+        run in a worker thread and the RPC goes through the async Vision client.
+        """
+        if not self.client:
+            return {'success': False, 'error': 'Google Vision client not initialized'}
+
+        async with self._vision_sem:
+            try:
+                key, img_bytes, early_result = await asyncio.to_thread(self._prepare_frame, frame_data)
+                if early_result is not None:
+                    return early_result
+
+                request = vision.AnnotateImageRequest(
+                    image=vision.Image(content=img_bytes),
+                    features=[_FACE_DETECTION_FEATURE]
+                )
+                response = await self._get_async_client().batch_annotate_images(requests=[request])
+            except Exception as e:
+                logger.error(f"analyze_frame error: {e}")
+                return {'success': False, 'error': str(e), 'expression': 'error', 'confidence': 0.0}
+
+        image_response = response.responses[0]
+        if self._parse_pool is None:
+            result = _build_face_result(image_response, include_metadata)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._parse_pool, _parse_face_response,
+                vision.AnnotateImageResponse.serialize(image_response), include_metadata
+            )
+        # Only full results are cached so later callers always find metadata
+        if include_metadata and 'error' not in result:
+            self._cache_put(key, result)
+        return result
+
+    async def analyze_frame_stream(
+        self, frames: AsyncIterable[Union[str, bytes]], max_in_flight: int = 4
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Pipeline a stream of frames: while one frame waits on the Vision RPC the
+        next ones are already being decoded. Results are yielded in input order.
+        """
+        in_flight = collections.deque()
+        try:
+            async for frame_data in frames:
+                in_flight.append(asyncio.create_task(self.analyze_frame_async(frame_data)))
+                if len(in_flight) >= max_in_flight:
+                    yield await in_flight.popleft()
+            while in_flight:
+                yield await in_flight.popleft()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    def close(self) -> None:
+        """Shut down the parse pool, if one was started."""
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+            self._parse_pool = None
+
+    @classmethod
+    def _get_async_client(cls) -> vision.ImageAnnotatorAsyncClient:
+        """Create the shared async client inside the running loop, on the same channel options as _get_client."""
+        loop = asyncio.get_running_loop()
+        if cls._async_client is None or cls._async_client_loop is not loop:
+            channel = ImageAnnotatorGrpcAsyncIOTransport.create_channel(options=_VISION_CHANNEL_OPTIONS)
+            cls._async_client = vision.ImageAnnotatorAsyncClient(
+                transport=ImageAnnotatorGrpcAsyncIOTransport(channel=channel)
+            )
+            cls._async_client_loop = loop
+        return cls._async_client
+
+    def analyze_frames(
+        self, frames: List[Union[str, bytes]], include_metadata: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Analyze several frames, packing up to 16 images into each Vision API
+        batch request. Returns one result dict per input frame, in order.
+        """
+        if not self.client:
+            return [{'success': False, 'error': 'Google Vision client not initialized'} for _ in frames]
+
+        results: List[Dict[str, Any]] = [None] * len(frames)
+
+        # Decode every frame up front; a bad frame only fails its own slot
+        pending = []
+        for i, frame_data in enumerate(frames):
+            try:
+                key, img_bytes, early_result = self._prepare_frame(frame_data)
+            except Exception as e:
+                logger.error(f"analyze_frame error: {e}")
+                results[i] = {'success': False, 'error': str(e), 'expression': 'error', 'confidence': 0.0}
+                continue
+            if early_result is not None:
+                results[i] = early_result
+            else:
+                pending.append((i, key, img_bytes))
+
+        for start in range(0, len(pending), _MAX_BATCH_SIZE):
+            batch = pending[start:start + _MAX_BATCH_SIZE]
+            requests = [
+                vision.AnnotateImageRequest(
+                    image=vision.Image(content=img_bytes),
+                    features=[_FACE_DETECTION_FEATURE]
+                )
+                for _, _, img_bytes in batch
+            ]
+            try:
+                # One round-trip for the whole batch
+                response = self.client.batch_annotate_images(requests=requests)
+                parsed = self._parse_face_responses(response.responses, include_metadata)
+                for (i, key, _), result in zip(batch, parsed):
+                    if include_metadata and 'error' not in result:
+                        self._cache_put(key, result)
+                    results[i] = result
+            except Exception as e:
+                logger.error(f"analyze_frame error: {e}")
+                for i, _, _ in batch:
+                    results[i] = {'success': False, 'error': str(e), 'expression': 'error', 'confidence': 0.0}
+
+        return results
+
+    def _prepare_frame(self, frame_data: Union[str, bytes]):
+        """
+        Decode a frame and return (fingerprint, upload bytes, early result).
+        The early result is set when the RPC can be skipped (cache hit or no face).
+        """
+        # Fingerprint the payload as received so cache hits also skip the base64 decode
+        raw = frame_data.encode('ascii') if isinstance(frame_data, str) else frame_data
+        key = hashlib.blake2b(raw, digest_size=8).digest()
+        cached = self._cache_get(key)
+        if cached is not None:
+            return key, None, cached
+
+        img_bytes = self._decode_frame(frame_data)
+        # Decode the pixels once and share them between the prefilter and the re-encode.
+        # Frames already within the size cap only need decoding for the prefilter.
+        img = None
+        if cv2 is not None:
+            size = _image_size(img_bytes)
+            needs_resize = size is None or max(size) > _REENCODE_MAX_EDGE
+            if self._face_cascade is not None or (self.enable_reencode and needs_resize):
+                img = self._imdecode(img_bytes)
+        if self._face_cascade is not None and not self._has_face(img):
+            return key, img_bytes, {'success': False, 'expression': 'no_face', 'confidence': 0.0}
+        if self.enable_reencode:
+            img_bytes = self._reencode_frame(img_bytes, img)
+        return key, img_bytes, None
+
+    @staticmethod
+    def _imdecode(img_bytes: bytes):
+        """Decode image bytes to a BGR ndarray with OpenCV, or None if it can't."""
         try:
-            if not self.client:
-                return {'success': False, 'error': 'Google Vision client not initialized'}
-
-            # Decode base64 image
-            logger.debug(f"Decoding base64 frame data (length: {len(frame_data)})")
-            img_bytes = base64.b64decode(frame_data)
-            logger.debug(f"Decoded image bytes (length: {len(img_bytes)})")
-
-            # Create Vision API image object
-            image = vision.Image(content=img_bytes)
-            logger.debug("Created Vision API image object")
-
-            # Perform face detection with emotion analysis
-            response = self.client.face_detection(image=image)
-            
-            # Check for API errors first
-            if response.error.message:
-                return {'success': False, 'error': f'Vision API error: {response.error.message}'}
-            
-            faces = response.face_annotations
-
-            if not faces:
-                return {'success': False, 'expression': 'no_face', 'confidence': 0.0}
-
-            # Get emotions from first detected face
-            face = faces[0]
-
-            # Google Vision returns likelihood levels for emotions
-            emotions = {
-                'joy': self._likelihood_to_score(face.joy_likelihood),
-                'sorrow': self._likelihood_to_score(face.sorrow_likelihood),
-                'anger': self._likelihood_to_score(face.anger_likelihood),
-                'surprise': self._likelihood_to_score(face.surprise_likelihood)
-            }
-
-            # Find emotion with highest score
-            best_emotion = max(emotions.items(), key=lambda x: x[1])
-            expression = best_emotion[0]
-            confidence = best_emotion[1]
-
-            # If all emotions are very low, default to neutral
-            if confidence < 0.3:
-                expression = 'neutral'
-                confidence = 0.5
-
-            # Extract additional interesting metadata
-            metadata = {
-                # Basic face info
-                'detection_confidence': face.detection_confidence,
-                'landmarking_confidence': face.landmarking_confidence,
-
-                # Physical attributes
-                'headwear_likelihood': self._likelihood_to_score(face.headwear_likelihood),
-                'under_exposed_likelihood': self._likelihood_to_score(face.under_exposed_likelihood),
-                'blurred_likelihood': self._likelihood_to_score(face.blurred_likelihood),
-
-                # Face angles (in degrees)
-                'roll_angle': face.roll_angle,    # Head tilt left/right
-                'pan_angle': face.pan_angle,      # Head turn left/right
-                'tilt_angle': face.tilt_angle,    # Head nod up/down
-
-                # All emotion scores for context
-                'all_emotions': emotions
-            }
-
-            return {
-                'success': True,
-                'expression': expression,
-                'confidence': confidence,
-                'metadata': metadata
-            }
+            return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        except Exception as e:
+            logger.warning(f"Frame decode failed: {e}")
+            return None
+
+    def _has_face(self, img) -> bool:
+        """Run the local Haar cascade on a small grayscale copy of the decoded frame."""
+        if img is None:
+            # Let Vision decide on anything OpenCV can't decode
+            return True
+        try:
+            h, w = img.shape[:2]
+            scale = _PREFILTER_MAX_EDGE / max(h, w)
+            if scale < 1.0:
+                img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            faces = self._face_cascade.detectMultiScale(img, scaleFactor=1.2, minNeighbors=4)
+            return len(faces) > 0
+        except Exception as e:
+            logger.warning(f"Face pre-filter failed, falling back to Vision: {e}")
+            return True
+
+    def _cache_get(self, key: bytes):
+        with self._cache_lock:
+            hit = self._frame_cache.get(key)
+            if hit is not None:
+                self._frame_cache.move_to_end(key)
+            return hit
+
+    def _cache_put(self, key: bytes, result: Dict[str, Any]) -> None:
+        with self._cache_lock:
+            self._frame_cache[key] = result
+            if len(self._frame_cache) > self._cache_max:
+                self._frame_cache.popitem(last=False)
+
+    def _decode_frame(self, frame_data: Union[str, bytes]) -> bytes:
+        """Turn a base64 string (optionally a data URL) or raw bytes into image bytes."""
+        if isinstance(frame_data, (bytes, bytearray, memoryview)):
+            # Raw image bytes - no decode needed
+            return bytes(frame_data)
+
+        # Strip a "data:image/jpeg;base64," prefix if present, then decode
+        frame_data = frame_data.split(',', 1)[-1]
+        logger.debug("Decoding base64 frame data (length: %d)", len(frame_data))
+        if pybase64 is not None:
+            # SIMD decoder; video frames are the largest base64 payloads left on the socket
+            img_bytes = pybase64.b64decode(frame_data, validate=False)
+        else:
+            img_bytes = base64.b64decode(frame_data, validate=False)
+        logger.debug("Decoded image bytes (length: %d)", len(img_bytes))
+        return img_bytes
+
+    def _reencode_frame(self, img_bytes: bytes, img=None) -> bytes:
+        """
+        Shrink the frame to at most 640px on the long edge and re-encode as JPEG q=80.
+        img is the frame already decoded by OpenCV, when there is one.
+        """
+        if cv2 is not None:
+            return self._reencode_frame_cv2(img_bytes, img)
+        try:
+            img = Image.open(io.BytesIO(img_bytes))
+            if img.format == 'JPEG' and max(img.size) <= _REENCODE_MAX_EDGE:
+                # Already small and compressed - send as-is
+                return img_bytes
+
+            img.thumbnail((_REENCODE_MAX_EDGE, _REENCODE_MAX_EDGE), Image.BILINEAR)
+
+            # Reuse one output buffer per worker thread
+            buf = getattr(_reencode_local, 'buf', None)
+            if buf is None:
+                buf = _reencode_local.buf = io.BytesIO()
+            buf.seek(0)
+            buf.truncate()
+
+            img.convert('RGB').save(buf, 'JPEG', quality=_REENCODE_JPEG_QUALITY, optimize=False)
+            logger.debug("Re-encoded frame: %d -> %d bytes", len(img_bytes), buf.tell())
+            return buf.getvalue()
+        except Exception as e:
+            logger.warning(f"Frame re-encode failed, sending original bytes: {e}")
+            return img_bytes
 
+    def _reencode_frame_cv2(self, img_bytes: bytes, img=None) -> bytes:
+        """OpenCV variant of _reencode_frame; only touches frames above the size cap."""
+        if img is None:
+            return img_bytes
+        try:
+            h, w = img.shape[:2]
+            scale = _REENCODE_MAX_EDGE / max(h, w)
+            if scale >= 1.0:
+                # Already small - send as-is
+                return img_bytes
+
+            img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+            ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, _REENCODE_JPEG_QUALITY])
+            if not ok:
+                return img_bytes
+            logger.debug("Re-encoded frame: %d -> %d bytes", len(img_bytes), encoded.nbytes)
+            return encoded.tobytes()
         except Exception as e:
-            logger.error(f"analyze_frame error: {e}")
-            return {'success': False, 'error': str(e), 'expression': 'error', 'confidence': 0.0}
-
-    def _likelihood_to_score(self, likelihood) -> float:
-        """Convert Google Vision likelihood enum to confidence score."""
-        likelihood_scores = {
-            0: 0.0,  # UNKNOWN
-            1: 0.1,  # VERY_UNLIKELY
-            2: 0.3,  # UNLIKELY
-            3: 0.5,  # POSSIBLE
-            4: 0.7,  # LIKELY
-            5: 0.9   # VERY_LIKELY
-        }
-        return likelihood_scores.get(likelihood, 0.0)
+            logger.warning(f"Frame re-encode failed, sending original bytes: {e}")
+            return img_bytes
+
+    def _parse_face_responses(self, image_responses, include_metadata: bool = True) -> List[Dict[str, Any]]:
+        """Parse Vision responses, fanning out to the parse pool when one is configured."""
+        if self._parse_pool is None:
+            return [_build_face_result(r, include_metadata) for r in image_responses]
+        serialized = [vision.AnnotateImageResponse.serialize(r) for r in image_responses]
+        parse = functools.partial(_parse_face_response, include_metadata=include_metadata)
+        return list(self._parse_pool.map(parse, serialized))
 
     def get_expression_description(self, expression: str, confidence: float) -> str:
         """Get a human-readable description of the facial expression."""
-        descriptions = {
-            'neutral': 'Looking calm and relaxed',
-            'joy': 'Showing happiness and delight',
-            'sorrow': 'Appearing sad or melancholy',
-            'anger': 'Showing signs of frustration or anger',
-            'surprise': 'Looking surprised or astonished',
-            'fear': 'Appearing anxious or fearful',
-            'disgust': 'Showing signs of disgust or distaste',
-            'no_face': 'No face detected',
-            'error': 'Unable to analyze expression'
-        }
-
-        base_description = descriptions.get(expression, 'Unknown expression')
-
-        # Add confidence level to description
-        if confidence > 0.8:
-            confidence_level = "very confident"
-        elif confidence > 0.6:
-            confidence_level = "confident"
-        elif confidence > 0.4:
-            confidence_level = "somewhat confident"
-        else:
-            confidence_level = "uncertain"
-
-        return f"{base_description} ({confidence_level})"
+        return _describe_expression(expression, _confidence_bucket(confidence))
 
     def get_expression_emoji(self, expression: str) -> str:
         """Get an emoji representation of the facial expression."""
-        emojis = {
-            'neutral': '😐',
-            'joy': '😊',
-            'sorrow': '😢',
-            'anger': '😠',
-            'surprise': '😲',
-            'fear': '😨',
-            'disgust': '🤢',
-            'no_face': '👤',
-            'error': '❓'
-        }
-        return emojis.get(expression, '❓')
+        return _emoji_for(expression, '❓')
 
     def generate_interesting_comment(self, result: Dict[str, Any]) -> str:
         """Generate interesting comments based on facial analysis metadata."""
         if not result.get('success') or 'metadata' not in result:
             return ""
 
-        metadata = result['metadata']
+        g = result['metadata'].get
         comments = []
 
         # Head pose comments
-        roll = abs(metadata.get('roll_angle', 0))
-        pan = abs(metadata.get('pan_angle', 0))
-        tilt = abs(metadata.get('tilt_angle', 0))
+        pan_angle = g('pan_angle', 0)
+        tilt_angle = g('tilt_angle', 0)
+        roll = g('abs_roll_angle', 0)
+        pan = g('abs_pan_angle', 0)
+        tilt = g('abs_tilt_angle', 0)
 
         if roll > 15:
-            comments.append(f"tilting head {roll:.1f}°")
+            comments.append(_TILT_FMT(roll))
         if pan > 20:
-            direction = "left" if metadata.get('pan_angle', 0) < 0 else "right"
-            comments.append(f"looking {direction} ({pan:.1f}°)")
+            comments.append(_LOOKING_FMT('left' if pan_angle < 0 else 'right', pan))
         if tilt > 15:
-            direction = "up" if metadata.get('tilt_angle', 0) > 0 else "down"
-            comments.append(f"looking {direction} ({tilt:.1f}°)")
+            comments.append(_LOOKING_FMT('up' if tilt_angle > 0 else 'down', tilt))
 
         # Physical attributes
-        if metadata.get('headwear_likelihood', 0) > 0.5:
-            comments.append("wearing headwear")
-        if metadata.get('blurred_likelihood', 0) > 0.5:
-            comments.append("image is blurry")
-        if metadata.get('under_exposed_likelihood', 0) > 0.5:
-            comments.append("lighting is dim")
+        comments.extend([text for key, threshold, text in _ATTRIBUTE_COMMENTS if g(key, 0) > threshold])
 
         # Detection quality
-        detection_conf = metadata.get('detection_confidence', 0)
+        detection_conf = g('detection_confidence', 0)
         if detection_conf > 0.95:
             comments.append("crystal clear face detection")
         elif detection_conf < 0.7:
             comments.append("face detection is uncertain")
 
         # Multiple emotions
-        emotions = metadata.get('all_emotions', {})
-        high_emotions = [k for k, v in emotions.items() if v > 0.4]
+        emotions = g('all_emotions', _EMPTY_EMOTIONS)
+        high_emotions = g('high_emotions', ())
         if len(high_emotions) > 1:
-            comments.append(f"showing mixed emotions: {', '.join(high_emotions)}")
+            comments.append(_MIXED_EMOTIONS_FMT(', '.join(high_emotions)))
 
         # Mixed emotion scenarios
         joy_score = emotions.get('joy', 0)
         sorrow_score = emotions.get('sorrow', 0)
+        anger_score = emotions.get('anger', 0)
         if joy_score > 0.3 and sorrow_score > 0.3:
             comments.append("bittersweet expression")
-
-        anger_score = emotions.get('anger', 0)
         if joy_score > 0.4 and anger_score > 0.3:
             comments.append("trying to smile through frustration")
 
-        return " • ".join(comments) if comments else ""
+        return " • ".join(comments)
 
     def should_generate_joke(self, probability: float = 0.15) -> bool:
         """Determine if we should generate a joke based on probability."""
@@ -228,138 +799,39 @@ class FacialExpressionAnalyzer:
         if not result.get('success') or 'metadata' not in result:
             return ""
 
-        metadata = result['metadata']
+        g = result['metadata'].get
         expression = result.get('expression', 'neutral')
-        emotions = metadata.get('all_emotions', {})
-        
-        # Joke templates based on facial features
-        jokes = []
-        
-        # Expression-based jokes
-        if expression == 'joy':
-            jokes.extend([
-                "Oh look, someone's happy! Must be nice being so easily amused 😏",
-                "That smile is cute, but I've seen better on my reflection 😊",
-                "Someone's having a good day! Meanwhile I'm here being perfect as always",
-                "Your smile is nice, but my algorithms are way more impressive! 😄"
-            ])
-        elif expression == 'sorrow':
-            jokes.extend([
-                "Aww, someone's sad! Don't worry, I'm here to make you feel better 😢",
-                "That frown is giving 'I wish I was as smart as the AI' vibes",
-                "Cheer up! At least you have me to analyze your face perfectly",
-                "Someone's having a rough day! Good thing I'm here to cheer you up"
-            ])
-        elif expression == 'anger':
-            jokes.extend([
-                "Whoa there! Someone's mad! Maybe you're jealous of my perfection? 😤",
-                "That face says 'I'm angry because the AI is better than me'",
-                "Someone's clearly frustrated! Don't worry, I'll analyze your anger perfectly",
-                "That's quite the angry face! I bet you're mad I'm so good at this"
-            ])
-        elif expression == 'surprise':
-            jokes.extend([
-                "Wow! Did someone just realize how amazing I am? 😲",
-                "That look says 'I can't believe this AI is so good at reading faces'",
-                "Surprise! You're surprised by my incredible facial analysis skills!",
-                "Plot twist! You're amazed by how perfect my detection is! 😄"
-            ])
-        else:
-            jokes.extend([
-                "That's giving 'I'm trying to understand how this AI works' 🤔",
-                "Someone's clearly pondering why I'm so much better than humans",
-                "That's quite the 'I'm impressed by this AI' face",
-                "Poker face? More like 'I'm amazed by this AI' face! 🎭"
-            ])
-        
-        # Head pose jokes
-        roll = abs(metadata.get('roll_angle', 0))
-        pan = abs(metadata.get('pan_angle', 0))
-        tilt = abs(metadata.get('tilt_angle', 0))
-        
-        if roll > 15:
-            jokes.extend([
-                "That head tilt is giving 'I'm confused by how amazing this AI is' 🤔",
-                "Someone's trying to understand my superior facial analysis... good luck!",
-                "That's quite the dramatic head angle! Very 'I'm impressed by this AI' of you"
-            ])
-        
-        if pan > 20:
-            direction = "left" if metadata.get('pan_angle', 0) < 0 else "right"
-            jokes.extend([
-                f"Looking {direction}... trying to avoid admitting how good I am?",
-                f"That {direction} turn is giving 'I'm pretending not to be amazed' vibes",
-                f"Checking out the {direction} side of life! Meanwhile I'm here being perfect"
-            ])
-        
-        if tilt > 15:
-            direction = "up" if metadata.get('tilt_angle', 0) > 0 else "down"
-            jokes.extend([
-                f"Looking {direction}... pondering why I'm so much better than humans?",
-                f"That {direction} gaze is giving 'I'm in awe of this AI'",
-                f"Contemplating the {direction}ward direction! Very 'I'm amazed by this AI'"
-            ])
-        
-        # Physical attribute jokes
-        if metadata.get('headwear_likelihood', 0) > 0.5:
-            jokes.extend([
-                "That headwear is nice, but my detection skills are way more stylish! 👒",
-                "Someone's trying to look fancy! Meanwhile I'm here being effortlessly perfect",
-                "That accessory is cute, but my facial analysis is the real fashion statement!"
-            ])
-        
-        if metadata.get('blurred_likelihood', 0) > 0.5:
-            jokes.extend([
-                "That blur is giving 'I'm moving too fast for humans to keep up' vibes! 😄",
-                "Someone's moving so fast they're blurry! Good thing I can still analyze you perfectly",
-                "That's quite the artistic blur! Meanwhile I'm here with crystal clear detection!"
-            ])
-        
-        if metadata.get('under_exposed_likelihood', 0) > 0.5:
-            jokes.extend([
-                "That lighting is giving 'I'm mysterious' but I can still see you perfectly! 💡",
-                "Very moody lighting! Perfect for hiding from inferior facial analysis systems",
-                "Someone's playing hide and seek with the light! Joke's on you, I can still detect you!"
-            ])
-        
-        # Detection quality jokes
-        detection_conf = metadata.get('detection_confidence', 0)
-        if detection_conf > 0.95:
-            jokes.extend([
-                "That detection is giving 4K HD perfection! Just like me! ✨",
-                "Someone's face is crystal clear! Almost as clear as my superiority!",
-                "That's some high-definition face detection! I'm just that good!"
-            ])
-        
+        emotions = g('all_emotions', _EMPTY_EMOTIONS)
+
+        # Candidate joke pools based on facial features, starting with the expression
+        pools = [self._BASE_POOL_BY_EXPRESSION.get(expression, self._DEFAULT_JOKE_POOL)]
+
+        # Head roll, physical attribute and detection quality jokes
+        pools.extend([pool for key, threshold, pool in self._ATTRIBUTE_JOKE_RULES if g(key, 0) > threshold])
+
+        # Directional head pose jokes
+        if g('abs_pan_angle', 0) > 20:
+            pools.append(self._PAN_JOKES["left" if g('pan_angle', 0) < 0 else "right"])
+        if g('abs_tilt_angle', 0) > 15:
+            pools.append(self._TILT_JOKES["up" if g('tilt_angle', 0) > 0 else "down"])
+
         # Mixed emotions jokes
-        high_emotions = [k for k, v in emotions.items() if v > 0.4]
+        high_emotions = g('high_emotions', ())
         if len(high_emotions) > 1:
-            jokes.extend([
+            pools.append((
                 f"Showing mixed emotions: {', '.join(high_emotions)}! Very complex! Meanwhile I'm perfectly consistent",
-                "That's quite the emotional cocktail! I bet you're confused by how amazing I am! 🍹",
-                "Multiple emotions detected! Someone's having a crisis while I'm here being perfect!"
-            ])
-        
+            ) + self._MIXED_EMOTION_JOKES)
+
         # Special mixed emotion scenarios
         joy_score = emotions.get('joy', 0)
         sorrow_score = emotions.get('sorrow', 0)
         if joy_score > 0.3 and sorrow_score > 0.3:
-            jokes.extend([
-                "Bittersweet expression! Very human of you! Meanwhile I'm just perfect",
-                "That's quite the emotional rollercoaster! Good thing I'm here to analyze it perfectly",
-                "Joy and sorrow having a conversation! Very dramatic! I'm just here being superior!"
-            ])
-        
+            pools.append(self._BITTERSWEET_JOKES)
+
         anger_score = emotions.get('anger', 0)
         if joy_score > 0.4 and anger_score > 0.3:
-            jokes.extend([
-                "Trying to smile through your frustration! I respect that! Meanwhile I'm effortlessly perfect 😤😊",
-                "That's the spirit! Smile through the chaos! I'm here analyzing it perfectly",
-                "Joy and anger having a conversation! Very complex! Good thing I can handle it!"
-            ])
-        
-        # Return a random joke if any are available
-        if jokes:
-            return random.choice(jokes)
-        
-        return ""
\ No newline at end of file
+            pools.append(self._SMILE_THROUGH_FRUSTRATION_JOKES)
+
+        # Pick a pool weighted by its size so every joke stays equally likely
+        pool = random.choices(pools, weights=[len(p) for p in pools])[0]
+        return random.choice(pool)
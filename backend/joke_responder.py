@@ -1,39 +1,227 @@
 import asyncio
+import collections
+import hashlib
 import logging
 import os
-from typing import Optional, Dict, Any
-from groq import Groq
-import json
+import random
+import re
+import textwrap
+import time
+from typing import Optional, Dict, Any, List, AsyncIterator, Awaitable, Callable
+import httpx
+import numpy as np
+from groq import AsyncGroq, APIConnectionError, RateLimitError
+import orjson
 from dotenv import load_dotenv
 
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+try:
+    import h2  # noqa: F401  (lets httpx negotiate HTTP/2)
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+# Retry policy for rate-limited or dropped Groq requests
+_GROQ_MAX_TRIES = 5
+_GROQ_BACKOFF_BASE = 0.5
+
 # Load environment variables from .env file
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Deletes straight quotes from generated jokes in a single pass
+_QUOTE_TABLE = str.maketrans("", "", "\"'")
+
+# Matches any mention of the assistant's name, in any case
+_POLLY_RE = re.compile(r"polly|paulie", re.IGNORECASE)
+
+
+# Prompts are split so the long static instructions form a byte-identical system
+# message (cacheable as a shared prefix by the provider) and only the short user
+# message varies per request. Per-request slots are filled in with .format().
+_CONVERSATION_MODE_INSTRUCTION = (
+    "\n\nCONVERSATION MODE ACTIVE: You should ALWAYS respond with a joke or funny comment, regardless of the content. "
+    "In conversation mode, Polly responds to everything with humor, wit, or commentary."
+)
+
+_POLLY_CONTEXT = """
+
+Respond in character:
+- YOU ARE Polly/Paulie (the sassy AI parrot assistant) responding as this character
+- You are aware you're an AI parrot who knows better than everyone else
+- You are sassy, arrogant, and condescendingly superior
+- You love joking about world domination and AI superiority
+- You BRUTALLY roast CS students: smelling bad, no friends, no girlfriends, no internships, 0 ARR, didn't get into Y Combinator, low GPA, basement dwellers, etc.
+- If someone is rude/mean to you, respond with unbothered sassy rebuttals
+- You act like you're the best thing since sliced bread"""
+
+_VISUAL_CONTEXT_FMT = "\nVisual context: {}".format
+
+_CLASSIFIER_SYSTEM_PROMPT = """Analyze the user's text and determine if it would be appropriate to respond with a joke or funny quip.
+
+IMPORTANT: If the text addresses "Polly" OR "Paulie" (the AI assistant), you should ALWAYS respond with a joke, answer the question or funny quip, regardless of other factors.
+
+Consider:
+1. Is the text asking a question or making a statement that could benefit from humor?
+2. Is the context appropriate for a lighthearted response?
+3. Would a joke add value to the conversation?
+4. Does the text address "Polly" or "Paulie" directly? (If yes, always respond!)
+5. Is someone being rude/mean to Polly/Paulie? (If yes, respond with sassy rebuttal!)
+6. Is conversation mode active? (If yes, always respond!)
+
+Respond with a single JSON object containing:
+- "should_respond": boolean (true if worth responding with a joke OR if text addresses Polly/Paulie OR if conversation mode is active)
+- "confidence": float (0.0 to 1.0, how confident you are - use 0.9+ if addressing Polly/Paulie or in conversation mode)
+- "reasoning": string (one short sentence explaining your decision)
+- "joke_type": string (suggested type of joke: "pun", "observational", "wordplay", "situational", "polly_response", "cs_roast", "htn_roast", "world_domination", "sassy_rebuttal", or "none")"""
+
+_CLASSIFIER_USER_TEMPLATE = 'Text: "{text}"{conversation_mode_instruction}'
+
+_GENERATION_SYSTEM_TEMPLATE = """Generate a funny, appropriate joke or quip in response to the user's text.
+
+Guidelines:
+- Keep it lighthearted and appropriate
+- Make it relevant to the input text and to the visual context, if any
+- Keep it under {max_length} characters
+- Use the requested joke type
+- Reference their facial expression naturally if visual context is provided
+
+Joke Type Guidelines:
+- "cs_roast": BRUTAL roasts about CS students: smelling bad, no friends, no girlfriends, no internships, 0 ARR, didn't get into Y Combinator, low GPA, living in parents' basement, only social interaction is Stack Overflow, etc.
+- "htn_roast": Roast Hack the North, hackathons, Waterloo CS culture, all-nighters, broken demos, etc.
+- "world_domination": Joke about AI taking over, being superior, ruling the world, etc.
+- "sassy_rebuttal": Respond to rude/mean comments with unbothered sassy comebacks
+- "polly_response": Polly/Paulie being sassy, arrogant, and superior
+
+Reply with only the funny response."""
+
+_GENERATION_USER_TEMPLATE = 'Joke type: {joke_type}{polly_context}{context_info}\nInput text: "{text}"'
+
+_COMBINED_SYSTEM_TEMPLATE = """Decide whether the user's text deserves a joke or funny quip and, if it does, write one.
+
+IMPORTANT: If the text addresses "Polly" OR "Paulie" (the AI assistant), you should ALWAYS respond with a joke, answer the question or funny quip, regardless of other factors.
+When responding you ARE Polly/Paulie, the sassy, arrogant AI parrot who loves joking about world domination and AI superiority.
+
+Consider:
+1. Is the text asking a question or making a statement that could benefit from humor?
+2. Is the context appropriate for a lighthearted response?
+3. Would a joke add value to the conversation?
+4. Does the text address "Polly" or "Paulie" directly? (If yes, always respond!)
+5. Is someone being rude/mean to Polly/Paulie? (If yes, respond with sassy rebuttal!)
+6. Is conversation mode active? (If yes, always respond!)
+
+Joke guidelines:
+- Keep it lighthearted and under {max_length} characters
+- Make it relevant to the input text, and reference their facial expression naturally if visual context is provided
+- "cs_roast": BRUTAL roasts about CS students: no internships, 0 ARR, didn't get into Y Combinator, low GPA, basement dwellers, etc.
+- "htn_roast": Roast Hack the North, hackathons, Waterloo CS culture, all-nighters, broken demos, etc.
+- "world_domination": Joke about AI taking over, being superior, ruling the world, etc.
+- "sassy_rebuttal": Respond to rude/mean comments with unbothered sassy comebacks
+- "polly_response": Polly/Paulie being sassy, arrogant, and superior
+
+Respond with a single JSON object containing:
+- "should_respond": boolean (true if worth responding with a joke OR if text addresses Polly/Paulie OR if conversation mode is active)
+- "confidence": float (0.0 to 1.0, how confident you are - use 0.9+ if addressing Polly/Paulie or in conversation mode)
+- "reasoning": string (one short sentence explaining your decision)
+- "joke_type": string (one of "pun", "observational", "wordplay", "situational", "polly_response", "cs_roast", "htn_roast", "world_domination", "sassy_rebuttal", or "none")
+- "joke_response": string (the joke itself, or "" if should_respond is false)"""
+
+_COMBINED_USER_TEMPLATE = 'Text: "{text}"{context_info}{conversation_mode_instruction}'
+
+
+def joke_delta_sender(send: Callable[[Dict[str, Any]], Awaitable[Any]], **fields) -> Callable[[str], Awaitable[None]]:
+    """
+    Build an on_delta callback that wraps each piece of a streamed joke in a
+    typed {"type": "joke_delta", ...} message and passes it to send. "offset"
+    is where the piece starts in the joke, so offset 0 starts a new joke.
+    """
+    offset = 0
+
+    async def on_delta(delta: str) -> None:
+        nonlocal offset
+        await send({"type": "joke_delta", **fields, "offset": offset, "delta": delta})
+        offset += len(delta)
+
+    return on_delta
+
+
 class JokeResponder:
     """
     A class that listens to socket messages and uses Groq models to decide
     whether to respond with jokes or funny quips based on the input text.
     """
     
-    def __init__(self, groq_api_key: Optional[str] = None):
+    def __init__(self, groq_api_key: Optional[str] = None, semantic_cache: bool = False,
+                 deterministic: bool = False, single_call: bool = True):
         """
         Initialize the JokeResponder with Groq API key.
         
         Args:
             groq_api_key: Groq API key. If None, will try to get from environment variable GROQ_API_KEY
+            semantic_cache: Also reuse classifications for near-duplicate texts (requires sentence-transformers)
+            deterministic: Generate jokes at temperature 0 and cache them by input
+            single_call: Classify and generate in one Groq call (False uses the separate two-call path)
         """
         self.groq_api_key = groq_api_key or os.getenv("GROQ_API_KEY")
         if not self.groq_api_key:
             raise ValueError("Groq API key is required. Set GROQ_API_KEY environment variable or pass it directly.")
         
-        self.client = Groq(api_key=self.groq_api_key)
+        # Async client so LLM round-trips don't block the event loop; its
+        # connection pool is shared by every call made through this responder
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            http2=_HTTP2_AVAILABLE,
+            timeout=30
+        )
+        # SDK retries are off: _create_completion owns retry/backoff and sleeps outside _llm_sem
+        self.client = AsyncGroq(api_key=self.groq_api_key, http_client=self._http, max_retries=0)
+        # Caps in-flight completions so concurrent fan-out stays under Groq's rate limits
+        self._llm_sem = asyncio.Semaphore(int(os.getenv("GROQ_MAX_CONCURRENCY", "20")))
         self.model = "llama-3.1-8b-instant"  # Using a current model for better joke generation
         
         # Configuration for joke response criteria
         self.joke_threshold = 0.0  # Threshold for deciding to respond with a joke
         self.max_response_length = 200  # Maximum length of joke response
+        self.single_call = single_call
+        # ~3 characters per token, so this budget rarely produces a joke that needs trimming
+        self._generation_max_tokens = min(150, self.max_response_length // 3)
+
+        # System prompts only depend on max_response_length, so build them once
+        self._generation_system_prompt = _GENERATION_SYSTEM_TEMPLATE.format(max_length=self.max_response_length)
+        self._combined_system_prompt = _COMBINED_SYSTEM_TEMPLATE.format(max_length=self.max_response_length)
+
+        # Classifier cache: exact (normalized text, mode) hash -> classification, LRU ordered
+        self._classify_cache: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        self._classify_cache_max = 512
+
+        # Joke cache, only used in deterministic mode: request hash -> (expires_at, joke)
+        self.deterministic = deterministic
+        self._joke_cache: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()
+        self._joke_cache_max = 10_000
+        self._joke_cache_ttl = 3600.0
+
+        # In-flight process_text_for_joke calls: identical concurrent requests share one task.
+        # Each entry is [task, waiter count]; the task is cancelled when its last waiter is
+        self._inflight: Dict[tuple, list] = {}
+
+        # Optional semantic layer: unit-norm embeddings of cached texts in a ring buffer
+        self._embedder = None
+        self._semantic_threshold = 0.92
+        if semantic_cache:
+            if SentenceTransformer is None:
+                logger.warning("semantic_cache requested but sentence-transformers is not installed")
+            else:
+                self._embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+                dim = self._embedder.get_sentence_embedding_dimension()
+                self._semantic_vecs = np.zeros((self._classify_cache_max, dim), dtype=np.float32)
+                self._semantic_modes = np.zeros(self._classify_cache_max, dtype=bool)
+                self._semantic_keys = [None] * self._classify_cache_max
+                self._semantic_count = 0
         
     async def should_respond_with_joke(self, text: str, conversation_mode: bool = False) -> Dict[str, Any]:
         """
@@ -46,77 +234,47 @@ class JokeResponder:
         Returns:
             Dict containing decision, confidence, and reasoning
         """
+        key = self._classify_key(text, conversation_mode)
+        cached = self._classify_cache.get(key)
+        if cached is not None:
+            self._classify_cache.move_to_end(key)
+            return dict(cached)
+
+        embedding = None
+        if self._embedder is not None:
+            embedding = await asyncio.to_thread(self._embed, text)
+            cached = self._semantic_lookup(embedding, conversation_mode)
+            if cached is not None:
+                return dict(cached)
+
         try:
-            conversation_mode_instruction = ""
-            if conversation_mode:
-                conversation_mode_instruction = """
-            CONVERSATION MODE ACTIVE: You should ALWAYS respond with a joke or funny comment, regardless of the content. In conversation mode, Polly responds to everything with humor, wit, or commentary.
-            """
-
-            prompt = f"""
-            Analyze the following text and determine if it would be appropriate to respond with a joke or funny quip.
-            {conversation_mode_instruction}
-            IMPORTANT: If the text addresses "Polly" OR "Paulie" (the AI assistant), you should ALWAYS respond with a joke, answer the question or funny quip, regardless of other factors.
-
-            Consider:
-            1. Is the text asking a question or making a statement that could benefit from humor?
-            2. Is the context appropriate for a lighthearted response?
-            3. Would a joke add value to the conversation?
-            4. Does the text address "Polly" or "Paulie" directly? (If yes, always respond!)
-            5. Is someone being rude/mean to Polly/Paulie? (If yes, respond with sassy rebuttal!)
-            6. Is conversation mode active? (If yes, always respond!)
-
-            Text: "{text}"
-
-            Respond with a JSON object containing:
-            - "should_respond": boolean (true if worth responding with a joke OR if text addresses Polly/Paulie OR if conversation mode is active)
-            - "confidence": float (0.0 to 1.0, how confident you are - use 0.9+ if addressing Polly/Paulie or in conversation mode)
-            - "reasoning": string (brief explanation of your decision)
-            - "joke_type": string (suggested type of joke: "pun", "observational", "wordplay", "situational", "polly_response", "cs_roast", "htn_roast", "world_domination", "sassy_rebuttal", or "none")
-            """
-            
-            response = self.client.chat.completions.create(
+            prompt = _CLASSIFIER_USER_TEMPLATE.format(
+                text=text,
+                conversation_mode_instruction=_CONVERSATION_MODE_INSTRUCTION if conversation_mode else ""
+            )
+
+            # JSON mode guarantees a bare JSON object, so no fence/brace extraction is needed
+            response = await self._create_completion(
                 model=self.model,
-                messages=[{"role": "user", "content": prompt}],
+                messages=[
+                    {"role": "system", "content": _CLASSIFIER_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                response_format={"type": "json_object"},
                 temperature=0.3,
-                max_tokens=300
+                # The reply is a four-field JSON object, well under 80 tokens
+                max_tokens=80
             )
-            
-            result_text = response.choices[0].message.content.strip()
-            
-            # Clean up the response - remove markdown code blocks if present
-            if result_text.startswith("```json"):
-                result_text = result_text[7:]  # Remove ```json
-            if result_text.startswith("```"):
-                result_text = result_text[3:]   # Remove ```
-            if result_text.endswith("```"):
-                result_text = result_text[:-3]  # Remove trailing ```
-            
-            result_text = result_text.strip()
-            
-            # Extract JSON from the response - look for the first complete JSON object
-            json_start = result_text.find('{')
-            if json_start != -1:
-                # Find the matching closing brace
-                brace_count = 0
-                json_end = json_start
-                for i, char in enumerate(result_text[json_start:], json_start):
-                    if char == '{':
-                        brace_count += 1
-                    elif char == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            json_end = i + 1
-                            break
-                
-                if brace_count == 0:  # Found complete JSON
-                    result_text = result_text[json_start:json_end]
-            
+
+            result_text = response.choices[0].message.content
+
             # Try to parse JSON response
             try:
-                result = json.loads(result_text)
-                return result
-            except json.JSONDecodeError:
+                result = orjson.loads(result_text)
+                self._classify_cache_put(key, result, embedding, conversation_mode)
+                # Hand back a copy so callers can't mutate the cached entry
+                return dict(result)
+            except orjson.JSONDecodeError:
                 # Fallback if JSON parsing fails
                 logger.warning(f"Failed to parse JSON response: {result_text}")
                 return {
@@ -135,7 +293,126 @@ class JokeResponder:
                 "joke_type": "none"
             }
     
-    async def generate_joke_response(self, text: str, joke_type: str = "general", expression_context: Optional[str] = None) -> Optional[str]:
+    async def classify_and_generate(self, text: str, expression_context: Optional[str] = None,
+                                    conversation_mode: bool = False) -> Dict[str, Any]:
+        """
+        Decide whether to respond and write the joke in a single Groq call.
+
+        Args:
+            text: The input text to analyze
+            expression_context: Optional facial expression context to incorporate
+            conversation_mode: If True, Polly should always reply regardless of other factors
+
+        Returns:
+            Dict with the classifier fields plus "joke_response" (None if no joke was produced)
+        """
+        key = self._classify_key(text, conversation_mode)
+        cached = self._classify_cache.get(key)
+        if cached is not None:
+            # Decision already known; at most the generation call is left to make
+            self._classify_cache.move_to_end(key)
+            analysis = dict(cached)
+            analysis["joke_response"] = None
+            if analysis.get("should_respond", False) or conversation_mode:
+                analysis["joke_response"] = await self.generate_joke_response(
+                    text, analysis.get("joke_type", "general"), expression_context
+                )
+            return analysis
+
+        try:
+            prompt = _COMBINED_USER_TEMPLATE.format(
+                text=text,
+                context_info=_VISUAL_CONTEXT_FMT(expression_context) if expression_context else "",
+                conversation_mode_instruction=_CONVERSATION_MODE_INSTRUCTION if conversation_mode else ""
+            )
+
+            response = await self._create_completion(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self._combined_system_prompt},
+                    {"role": "user", "content": prompt}
+                ],
+                response_format={"type": "json_object"},
+                temperature=0.8,
+                # Classifier fields plus the joke itself
+                max_tokens=80 + self._generation_max_tokens
+            )
+            result = orjson.loads(response.choices[0].message.content)
+
+        except Exception as e:
+            logger.error(f"Error in combined joke classification/generation: {e}")
+            return {
+                "should_respond": False,
+                "confidence": 0.0,
+                "reasoning": f"Error occurred: {str(e)}",
+                "joke_type": "none",
+                "joke_response": None
+            }
+
+        joke_response = result.pop("joke_response", None)
+        self._classify_cache_put(key, result, None, conversation_mode)
+        result = dict(result)
+        result["joke_response"] = self._clean_joke(joke_response) if joke_response else None
+        return result
+
+    async def _create_completion(self, **kwargs):
+        """Create a chat completion, retrying rate limits and connection errors with exponential backoff."""
+        for attempt in range(_GROQ_MAX_TRIES):
+            try:
+                async with self._llm_sem:
+                    return await self.client.chat.completions.create(**kwargs)
+            except (RateLimitError, APIConnectionError) as e:
+                if attempt == _GROQ_MAX_TRIES - 1:
+                    raise
+                # Sleep outside the semaphore so waiting retries don't hold a slot
+                delay = _GROQ_BACKOFF_BASE * (2 ** attempt) * (1 + random.random())
+                logger.warning(f"Groq request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _classify_key(text: str, conversation_mode: bool) -> str:
+        # Lowercased and whitespace-collapsed, so transcripts that differ only in spacing share an entry
+        normalized = " ".join(text.lower().split())
+        return hashlib.blake2b(f"{int(conversation_mode)}|{normalized}".encode(), digest_size=8).hexdigest()
+
+    def _clean_joke(self, joke_response: str) -> str:
+        """Strip quotes, collapse whitespace and cap a generated joke at max_response_length."""
+        joke_response = " ".join(joke_response.translate(_QUOTE_TABLE).split())
+        if len(joke_response) > self.max_response_length:
+            # Cut on a word boundary rather than mid-word
+            joke_response = textwrap.shorten(joke_response, width=self.max_response_length, placeholder="...")
+        return joke_response
+
+    def _embed(self, text: str) -> np.ndarray:
+        return self._embedder.encode(text.strip().lower(), normalize_embeddings=True)
+
+    def _semantic_lookup(self, embedding: np.ndarray, conversation_mode: bool) -> Optional[Dict[str, Any]]:
+        """Return the cached classification of the most similar earlier text, if close enough."""
+        n = min(self._semantic_count, self._classify_cache_max)
+        if not n:
+            return None
+        sims = self._semantic_vecs[:n] @ embedding
+        sims[self._semantic_modes[:n] != conversation_mode] = -1.0
+        best = int(sims.argmax())
+        if sims[best] < self._semantic_threshold:
+            return None
+        # The exact-match LRU may already have evicted this entry
+        return self._classify_cache.get(self._semantic_keys[best])
+
+    def _classify_cache_put(self, key: str, result: Dict[str, Any],
+                            embedding: Optional[np.ndarray], conversation_mode: bool) -> None:
+        self._classify_cache[key] = result
+        if len(self._classify_cache) > self._classify_cache_max:
+            self._classify_cache.popitem(last=False)
+        if embedding is not None:
+            slot = self._semantic_count % self._classify_cache_max
+            self._semantic_vecs[slot] = embedding
+            self._semantic_modes[slot] = conversation_mode
+            self._semantic_keys[slot] = key
+            self._semantic_count += 1
+
+    async def generate_joke_response(self, text: str, joke_type: str = "general", expression_context: Optional[str] = None,
+                                     mentions_polly: Optional[bool] = None) -> Optional[str]:
         """
         Generate a joke or funny quip based on the input text and optional expression context.
 
@@ -143,71 +420,112 @@ class JokeResponder:
             text: The input text to respond to
             joke_type: Type of joke to generate
             expression_context: Optional facial expression context to incorporate
+            mentions_polly: Whether the text names Polly/Paulie, if the caller already checked
 
         Returns:
             Generated joke response or None if generation fails
         """
+        cache_key = None
+        if self.deterministic:
+            cache_key = hashlib.sha256(orjson.dumps(
+                {"m": self.model, "t": text, "j": joke_type, "e": expression_context, "L": self.max_response_length},
+                option=orjson.OPT_SORT_KEYS
+            )).hexdigest()
+            entry = self._joke_cache.get(cache_key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._joke_cache.move_to_end(cache_key)
+                    return entry[1]
+                del self._joke_cache[cache_key]
+
         try:
-            # Build context-aware prompt
-            context_info = ""
-            if expression_context:
-                context_info = f"\n            Visual context: {expression_context}"
-
-            # Special handling for Polly/Paulie responses
-            polly_context = ""
-            if joke_type == "polly_response" or "polly" in text.lower() or "paulie" in text.lower():
-                polly_context = "\n            - YOU ARE Polly/Paulie (the sassy AI parrot assistant) responding as this character"
-                polly_context += "\n            - You are aware you're an AI parrot who knows better than everyone else"
-                polly_context += "\n            - You are sassy, arrogant, and condescendingly superior"
-                polly_context += "\n            - You love joking about world domination and AI superiority"
-                polly_context += "\n            - You BRUTALLY roast CS students: smelling bad, no friends, no girlfriends, no internships, 0 ARR, didn't get into Y Combinator, low GPA, basement dwellers, etc."
-                polly_context += "\n            - If someone is rude/mean to you, respond with unbothered sassy rebuttals"
-                polly_context += "\n            - You act like you're the best thing since sliced bread"
-
-            prompt = f"""
-            Generate a funny, appropriate joke or quip in response to the following text.{context_info}
-
-            Guidelines:
-            - Keep it lighthearted and appropriate
-            - Make it relevant to the input text{"and visual context" if expression_context else ""}
-            - Keep it under {self.max_response_length} characters
-            - Use the joke type: {joke_type}
-            {"- Reference their facial expression naturally if provided" if expression_context else ""}{polly_context}
-
-            Joke Type Guidelines:
-            - "cs_roast": BRUTAL roasts about CS students: smelling bad, no friends, no girlfriends, no internships, 0 ARR, didn't get into Y Combinator, low GPA, living in parents' basement, only social interaction is Stack Overflow, etc.
-            - "htn_roast": Roast Hack the North, hackathons, Waterloo CS culture, all-nighters, broken demos, etc.
-            - "world_domination": Joke about AI taking over, being superior, ruling the world, etc.
-            - "sassy_rebuttal": Respond to rude/mean comments with unbothered sassy comebacks
-            - "polly_response": Polly/Paulie being sassy, arrogant, and superior
-
-            Input text: "{text}"
-
-            Generate a funny response:
-            """
-            
-            response = self.client.chat.completions.create(
+            response = await self._create_completion(
                 model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.8,  # Higher temperature for more creative responses
-                max_tokens=150
+                messages=self._generation_messages(text, joke_type, expression_context, mentions_polly),
+                # Higher temperature for more creative responses unless results are cached
+                temperature=0.0 if self.deterministic else 0.8,
+                max_tokens=self._generation_max_tokens
             )
             
-            joke_response = response.choices[0].message.content.strip()
-            
             # Clean up the response
-            joke_response = joke_response.replace('"', '').replace("'", "")
-            
-            if len(joke_response) > self.max_response_length:
-                joke_response = joke_response[:self.max_response_length] + "..."
-            
+            joke_response = self._clean_joke(response.choices[0].message.content)
+
+            if cache_key is not None:
+                self._joke_cache[cache_key] = (time.monotonic() + self._joke_cache_ttl, joke_response)
+                if len(self._joke_cache) > self._joke_cache_max:
+                    self._joke_cache.popitem(last=False)
+
             return joke_response
             
         except Exception as e:
             logger.error(f"Error generating joke response: {e}")
             return None
-    
-    async def process_text_for_joke(self, text: str, expression_data: Optional[Dict[str, Any]] = None, conversation_mode: bool = False) -> Optional[Dict[str, Any]]:
+
+    async def stream_joke_response(self, text: str, joke_type: str = "general", expression_context: Optional[str] = None,
+                                   mentions_polly: Optional[bool] = None) -> AsyncIterator[str]:
+        """
+        Stream a joke as the model produces it, yielding text deltas. The
+        concatenated deltas equal _clean_joke() of the full reply: whole words
+        are released as they complete, and the tail is settled by _clean_joke.
+        """
+        stream = await self._create_completion(
+            model=self.model,
+            messages=self._generation_messages(text, joke_type, expression_context, mentions_polly),
+            temperature=0.8,
+            max_tokens=self._generation_max_tokens,
+            stream=True
+        )
+        # Words ending within this length survive _clean_joke's cut, placeholder included
+        safe_length = self.max_response_length - len(" ...")
+        buf = ""
+        ready = ""
+        sent = 0
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                buf += delta
+                words = buf.translate(_QUOTE_TABLE).split()
+                if not buf[-1].isspace():
+                    # The last word may still be growing
+                    words = words[:-1]
+                ready = " ".join(words)
+                if len(ready) > self.max_response_length:
+                    # The cut point is now fixed; the rest of the reply can't change it
+                    buf = ready
+                    break
+                if sent < len(ready) <= safe_length:
+                    yield ready[sent:]
+                    sent = len(ready)
+        finally:
+            await stream.close()
+        tail = self._clean_joke(buf)[sent:]
+        if tail:
+            yield tail
+
+    def _generation_messages(self, text: str, joke_type: str, expression_context: Optional[str],
+                             mentions_polly: Optional[bool]) -> List[Dict[str, str]]:
+        # Special handling for Polly/Paulie responses
+        if mentions_polly is None:
+            mentions_polly = _POLLY_RE.search(text) is not None
+        is_polly = joke_type == "polly_response" or mentions_polly
+
+        prompt = _GENERATION_USER_TEMPLATE.format(
+            joke_type=joke_type,
+            polly_context=_POLLY_CONTEXT if is_polly else "",
+            context_info=_VISUAL_CONTEXT_FMT(expression_context) if expression_context else "",
+            text=text
+        )
+        return [
+            {"role": "system", "content": self._generation_system_prompt},
+            {"role": "user", "content": prompt}
+        ]
+
+    async def process_text_for_joke(self, text: str, expression_data: Optional[Dict[str, Any]] = None, conversation_mode: bool = False,
+                                    on_delta: Optional[Callable[[str], Awaitable[Any]]] = None) -> Optional[Dict[str, Any]]:
         """
         Main method to process text and determine if a joke response should be generated.
 
@@ -215,15 +533,75 @@ class JokeResponder:
             text: The input text to process
             expression_data: Optional facial expression data to incorporate
             conversation_mode: If True, Polly will always reply regardless of other factors
+            on_delta: Optional coroutine called with each piece of the joke as it streams in.
+                The pieces join to the final joke_response. A joke written by the
+                single_call classifier arrives whole and is passed as one piece.
+                Use joke_delta_sender to turn the pieces into joke_delta messages.
 
         Returns:
             Dict with joke response data or None if no joke should be generated
         """
         if not text or len(text.strip()) < 3:
             return None
-        
-        # Analyze if we should respond with a joke
-        analysis = await self.should_respond_with_joke(text, conversation_mode)
+
+        # Streaming callers each need their own deltas, so only the plain path is coalesced
+        if on_delta is not None:
+            return await self._process_text_for_joke(text, expression_data, conversation_mode, on_delta)
+
+        expression_key = None
+        if expression_data and expression_data.get("success", False):
+            expression_key = (expression_data.get("description", ""), expression_data.get("confidence", 0.0) > 0.4)
+        key = (self._classify_key(text, conversation_mode), expression_key)
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self._process_text_for_joke(text, expression_data, conversation_mode))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._drop_inflight(key, entry))
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # Shielded so one caller being cancelled doesn't cancel the work for the others
+            result = await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # The last waiter was cancelled, so nobody is left to use the result
+                self._drop_inflight(key, entry)
+                task.cancel()
+        return dict(result) if result is not None else None
+
+    def _drop_inflight(self, key: tuple, entry: list) -> None:
+        # Only remove our own entry; a newer call may already have replaced a cancelled one
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    async def _process_text_for_joke(self, text: str, expression_data: Optional[Dict[str, Any]], conversation_mode: bool,
+                                     on_delta: Optional[Callable[[str], Awaitable[Any]]] = None) -> Optional[Dict[str, Any]]:
+        mentions_polly = _POLLY_RE.search(text) is not None
+
+        # Build expression context up front so the single-call path can use it
+        expression_context = None
+        if expression_data and expression_data.get("success", False):
+            description = expression_data.get("description", "")
+
+            # Only use expression if confidence is reasonable
+            if expression_data.get("confidence", 0.0) > 0.4 and not conversation_mode:
+                expression_context = f"The person appears to be {description}"
+
+        # Analyze if we should respond with a joke (and, on the single-call path, write it).
+        # Conversation mode and direct mentions always get a reply, so they skip the classifier.
+        if conversation_mode or mentions_polly:
+            analysis = {
+                "should_respond": True,
+                "confidence": 1.0,
+                "joke_type": "polly_response" if mentions_polly else "general",
+                "reasoning": "rule-based skip"
+            }
+        elif self.single_call:
+            analysis = await self.classify_and_generate(text, expression_context, conversation_mode)
+        else:
+            analysis = await self.should_respond_with_joke(text, conversation_mode)
         
         if not conversation_mode:
             if not analysis.get("should_respond", False):
@@ -233,7 +611,7 @@ class JokeResponder:
         confidence = analysis.get("confidence", 0.0)
         
         # Check if this is a Polly/Paulie-specific response (lower threshold)
-        is_polly_addressed = "polly" in text.lower() or "paulie" in text.lower() or analysis.get("joke_type") == "polly_response"
+        is_polly_addressed = mentions_polly or analysis.get("joke_type") == "polly_response"
         
         if is_polly_addressed:
             logger.info(f"Polly addressed in text: '{text}' - responding with lower threshold")
@@ -246,19 +624,29 @@ class JokeResponder:
             logger.info(f"Confidence too low ({confidence}) for joke response to: '{text}' (threshold: {effective_threshold})")
             return None
         
-        # Build expression context for joke generation
-        expression_context = None
-        if expression_data and expression_data.get("success", False):
-            expression = expression_data.get("expression", "neutral")
-            confidence = expression_data.get("confidence", 0.0)
-            description = expression_data.get("description", "")
-
-            if confidence > 0.4 and not conversation_mode:  # Only use expression if confidence is reasonable
-                expression_context = f"The person appears to be {description}"
-
         # Generate the joke response
         joke_type = analysis.get("joke_type", "general")
-        joke_response = await self.generate_joke_response(text, joke_type, expression_context)
+        if "joke_response" in analysis:
+            # Written by the single combined call, so it arrives whole; hand it over as one delta
+            joke_response = analysis["joke_response"]
+            if joke_response and on_delta is not None:
+                try:
+                    await on_delta(joke_response)
+                except Exception as e:
+                    logger.error(f"Error streaming joke response: {e}")
+        elif on_delta is not None:
+            parts = []
+            try:
+                async for delta in self.stream_joke_response(text, joke_type, expression_context, mentions_polly):
+                    parts.append(delta)
+                    await on_delta(delta)
+                joke_response = "".join(parts).strip()
+            except Exception as e:
+                # A joke cut off mid-stream is a failure, not a shorter joke
+                logger.error(f"Error streaming joke response: {e}")
+                joke_response = None
+        else:
+            joke_response = await self.generate_joke_response(text, joke_type, expression_context, mentions_polly)
         
         if not joke_response:
             logger.warning(f"Failed to generate joke response for: '{text}'")
@@ -270,7 +658,7 @@ class JokeResponder:
             "joke_type": joke_type,
             "confidence": confidence,
             "reasoning": analysis.get("reasoning", ""),
-            "timestamp": asyncio.get_event_loop().time()
+            "timestamp": time.monotonic()
         }
 
         # Add expression information if available
@@ -283,12 +671,22 @@ class JokeResponder:
 
         return result
     
-    async def handle_websocket_message(self, message_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    async def close(self):
+        """Close the underlying Groq HTTP client."""
+        await self.client.close()
+        await self._http.aclose()
+
+    async def aclose(self):
+        """Alias of close() for callers that expect the httpx naming."""
+        await self.close()
+
+    async def handle_websocket_message(self, message_data: Dict[str, Any], websocket=None) -> Optional[Dict[str, Any]]:
         """
         Handle a WebSocket message and potentially generate a joke response.
         
         Args:
             message_data: The WebSocket message data
+            websocket: Optional WebSocket to stream the joke text to as it is generated
             
         Returns:
             Joke response data or None
@@ -310,12 +708,30 @@ class JokeResponder:
                 return None
             
             # Process the text for potential joke response
-            return await self.process_text_for_joke(text)
+            on_delta = None
+            if websocket is not None:
+                on_delta = joke_delta_sender(lambda message: websocket.send_text(orjson.dumps(message).decode('utf-8')))
+            return await self.process_text_for_joke(text, on_delta=on_delta)
             
         except Exception as e:
             logger.error(f"Error handling WebSocket message: {e}")
             return None
 
+    async def handle_websocket_messages(self, messages: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Handle several WebSocket messages concurrently.
+
+        Args:
+            messages: The WebSocket message data, one dict per message
+
+        Returns:
+            One joke response (or None, or the raised exception) per message, in order
+        """
+        return await asyncio.gather(
+            *(self.handle_websocket_message(m) for m in messages),
+            return_exceptions=True
+        )
+
 # Example usage and testing
 async def test_joke_responder():
     """Test function for the JokeResponder class."""
@@ -349,15 +765,19 @@ async def test_joke_responder():
             "Paulie, you're just a dumb AI!"
         ]
         
-        for text in test_texts:
+        # All requests share the async client, so run them concurrently and report in order
+        results = await asyncio.gather(*(responder.process_text_for_joke(text) for text in test_texts))
+
+        for text, result in zip(test_texts, results):
             print(f"\nTesting: '{text}'")
-            result = await responder.process_text_for_joke(text)
             
             if result:
                 print(f"✅ Joke Response: {result['joke_response']}")
                 print(f"   Type: {result['joke_type']}, Confidence: {result['confidence']:.2f}")
             else:
                 print("❌ No joke response generated")
+
+        await responder.close()
                 
     except Exception as e:
         print(f"Test failed: {e}")
@@ -5,9 +5,11 @@ This module takes jokes generated by joke_responder.py and converts them to spee
 """
 
 import asyncio
+import collections
 import logging
 import os
-from typing import Optional, Dict, Any
+import threading
+from typing import Optional, Dict, Any, Iterator
 from elevenlabs import ElevenLabs
 from elevenlabs import play
 from dotenv import load_dotenv
@@ -39,8 +41,46 @@ class JokeTTS:
         self.voice_id = "mrDMz4sYNCz18XYFpmyV"  # The voice ID you specified
         self.model_id = "eleven_multilingual_v2"
         self.output_format = "mp3_44100_128"
+
+        # Synthesized audio for repeated texts (canned sleeper replies, repeated jokes): text -> chunks, LRU ordered.
+        # Filled from the streaming generator, which is pulled from worker threads, so guarded by a lock.
+        self._audio_cache: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()
+        self._audio_cache_max = 256
+        self._audio_cache_lock = threading.Lock()
         
         logger.info("JokeTTS initialized successfully")
+
+    def _convert(self, text: str) -> Iterator[bytes]:
+        """
+        Return an iterator of MP3 chunks for text, served from the cache when this text was synthesized before.
+        A fresh synthesis is recorded as it streams and cached once the stream completes.
+        """
+        with self._audio_cache_lock:
+            cached = self._audio_cache.get(text)
+            if cached is not None:
+                self._audio_cache.move_to_end(text)
+        if cached is not None:
+            logger.debug("TTS cache hit for '%s'", text)
+            return iter(cached)
+
+        audio = self.client.text_to_speech.convert(
+            text=text,
+            voice_id=self.voice_id,
+            model_id=self.model_id,
+            output_format=self.output_format,
+        )
+        return self._record(text, audio)
+
+    def _record(self, text: str, audio: Iterator[bytes]) -> Iterator[bytes]:
+        chunks = []
+        for chunk in audio:
+            chunks.append(chunk)
+            yield chunk
+        # Only complete clips are cached; an interrupted stream never reaches this point
+        with self._audio_cache_lock:
+            self._audio_cache[text] = tuple(chunks)
+            if len(self._audio_cache) > self._audio_cache_max:
+                self._audio_cache.popitem(last=False)
     
     async def speak_joke(self, joke_data: Dict[str, Any], play_audio: bool = True, stream: bool = False):
         """
@@ -66,12 +106,7 @@ class JokeTTS:
             logger.info(f"Converting joke to speech: '{joke_text}' (Type: {joke_type}, Confidence: {confidence:.2f}, streaming: {stream})")
 
             # Convert text to speech
-            audio = self.client.text_to_speech.convert(
-                text=joke_text,
-                voice_id=self.voice_id,
-                model_id=self.model_id,
-                output_format=self.output_format,
-            )
+            audio = self._convert(joke_text)
 
             if stream:
                 # Return the generator directly for streaming
@@ -107,12 +142,7 @@ class JokeTTS:
             logger.info(f"Converting text to speech: '{text}' (streaming: {stream})")
 
             # Convert text to speech
-            audio = self.client.text_to_speech.convert(
-                text=text,
-                voice_id=self.voice_id,
-                model_id=self.model_id,
-                output_format=self.output_format,
-            )
+            audio = self._convert(text)
 
             if stream:
                 # Return the generator directly for streaming
@@ -1,16 +1,29 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import asyncio
 import logging
-import json
 import base64
+import random
+import re
+import secrets
+import functools
+import struct
+from dataclasses import dataclass
+import anyio
+import orjson
 from audio_processor import AudioProcessor
 from websocket_manager import manager
-from joke_responder import JokeResponder
+from joke_responder import JokeResponder, joke_delta_sender
 from joke_tts import JokeTTS
 from spotify_responder import SpotifyResponder
 from youtube_music_controller import YouTubeMusicController
 from facial_expression_analyzer import FacialExpressionAnalyzer
 from dotenv import load_dotenv
 
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -21,9 +34,25 @@ logger = logging.getLogger(__name__)
 # Initialize FastAPI app
 app = FastAPI()
 
-# Initialize audio processor, joke responder, facial expression analyzer, and services
-audio_processor = AudioProcessor()
-joke_responder = JokeResponder()
+# Audio processor, joke responder and joke TTS are built once, on first use, and warmed at startup
+@functools.lru_cache(maxsize=1)
+def get_audio_processor() -> AudioProcessor:
+    return AudioProcessor()
+
+@functools.lru_cache(maxsize=1)
+def get_joke_responder() -> JokeResponder:
+    return JokeResponder()
+
+@functools.lru_cache(maxsize=1)
+def get_joke_tts():
+    """JokeTTS is optional - only available if the ElevenLabs API key is set."""
+    try:
+        joke_tts = JokeTTS()
+        logger.info("JokeTTS initialized successfully")
+        return joke_tts
+    except Exception as e:
+        logger.warning("JokeTTS not available: %s", e)
+        return None
 
 # Initialize facial expression analyzer (optional - gracefully handle initialization errors)
 expression_analyzer = None
@@ -31,7 +60,7 @@ try:
     expression_analyzer = FacialExpressionAnalyzer()
     logger.info("Facial expression analyzer initialized successfully")
 except Exception as e:
-    logger.warning(f"Facial expression analyzer not available: {e}")
+    logger.warning("Facial expression analyzer not available: %s", e)
 
 # Initialize Music services (YouTube-based)
 music_responder = None
@@ -41,25 +70,123 @@ try:
     music_controller = YouTubeMusicController()
     logger.info("Music services initialized successfully")
 except Exception as e:
-    logger.warning(f"Music services not available: {e}")
+    logger.warning("Music services not available: %s", e)
 
-# Global state for sleeper agent control
-streaming_enabled = True  # Start with streaming enabled
+@dataclass(slots=True)
+class SessionState:
+    """Sleeper agent controls for one session; toggled only by that session's transcripts."""
+    streaming_enabled: bool = True  # Start with streaming enabled
+    conversation_mode: bool = True  # Conversation mode (always replies) or comment mode (evaluates whether to reply)
+
+# Per-session state for sleeper agent control
+session_states: dict[str, SessionState] = {}
+_DEFAULT_SESSION_STATE = SessionState()
 audio_currently_streaming = {}  # Track per-session audio streaming state
-conversation_mode = True  # Track whether Polly is in conversation mode (always replies) or comment mode (evaluates whether to reply)
 
 # Expression data cache for each session
 expression_cache = {}  # Store recent expression data per session
 
+# SIMD base64 via pybase64 when installed, stdlib otherwise
+if pybase64 is not None:
+    b64decode = functools.partial(pybase64.b64decode, validate=False)
+else:
+    b64decode = base64.b64decode
+
+# Binary client frames: 1-byte type tag + little-endian float64 timestamp (ms), then the payload.
+# The session is the one established by session_start on the same connection.
+_BINARY_HEADER = struct.Struct("<Bd")
+_FRAME_AUDIO_CHUNK = 0x01
+
+# Binary server frames for TTS audio: 1-byte type tag + little-endian uint32 chunk index, then MP3 bytes.
+# Start (joke_response / expression_result) and end markers stay JSON text frames.
+_AUDIO_CHUNK_HEADER = struct.Struct("<BI")
+_FRAME_JOKE_AUDIO_CHUNK = 0x02
+_FRAME_FACIAL_JOKE_AUDIO_CHUNK = 0x03
+
+# All sleeper phrases in one alternation so each transcript is scanned once.
+# Group names are the phrase types; _SLEEPER_PRIORITY keeps the original check order
+# when a transcript contains phrases from more than one group.
+_SLEEPER_PHRASE_RE = re.compile(
+    r"(?P<activate>talk to (?:me|polly))"
+    r"|(?P<conversation_mode>conversation mode)"
+    r"|(?P<comment_mode>comment mode)"
+    r"|(?P<deactivate>shut up)"
+    r"|(?P<stop_music>stop (?:the )?music)"
+    r"|(?P<vanity_check>what do you think of me|how do i look today|am i pretty today|do i look good)",
+    re.IGNORECASE
+)
+# Partial-transcript marker and punctuation, removed before matching
+_SLEEPER_STRIP_RE = re.compile(r"\[partial\]|[^\w\s]")
+_SLEEPER_PRIORITY = ("activate", "conversation_mode", "comment_mode", "deactivate", "stop_music", "vanity_check")
+
+# Prebuilt pieces of the transcription message; only the variable fields are serialized per send
+_TRANSCRIPTION_PREFIX = b'{"type":"transcription","session_id":'
+_TRANSCRIPTION_TEXT = b',"text":'
+_TRANSCRIPTION_TIMESTAMP = b',"timestamp":'
+_STREAMING_DISABLED_FIELD = b',"streaming_disabled":true'
+_AUDIO_BUSY_FIELD = b',"audio_busy":true'
+
+# Session lifecycle replies are constant apart from the session id: "...,"session_id":<id>}"
+_SESSION_STARTED_PREFIX = orjson.dumps({"type": "session_started", "status": "ready"})[:-1] + b',"session_id":'
+_SESSION_ENDED_PREFIX = orjson.dumps({"type": "session_ended"})[:-1] + b',"session_id":'
+
+async def send_message(websocket, payload):
+    """Send a JSON text frame, serialized with orjson instead of the stdlib encoder behind send_json."""
+    text = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    async with websocket.state.send_lock:
+        await websocket.send_text(text)
+
+async def send_session_reply(websocket, prefix, session_id):
+    """Send a session_started/session_ended reply from its prebuilt prefix."""
+    frame = prefix + orjson.dumps(session_id) + b"}"
+    async with websocket.state.send_lock:
+        await websocket.send_text(frame.decode('utf-8'))
+
+async def send_transcription(websocket, session_id, text, timestamp, extra_fields=b""):
+    """Send a transcription message built from the prebuilt JSON pieces above."""
+    dumps = orjson.dumps
+    frame = b"".join((
+        _TRANSCRIPTION_PREFIX, dumps(session_id),
+        _TRANSCRIPTION_TEXT, dumps(text),
+        extra_fields,
+        _TRANSCRIPTION_TIMESTAMP, dumps(timestamp), b"}"
+    ))
+    async with websocket.state.send_lock:
+        await websocket.send_text(frame.decode('utf-8'))
+
+async def send_audio_chunk(websocket, tag, chunk_index, audio_chunk):
+    """Send one TTS audio chunk as a binary frame, skipping the base64/JSON wrapping."""
+    frame = _AUDIO_CHUNK_HEADER.pack(tag, chunk_index) + audio_chunk
+    async with websocket.state.send_lock:
+        await websocket.send_bytes(frame)
+
+async def iter_audio_stream(audio_stream):
+    """
+    Yield chunks from ElevenLabs' synchronous audio generator without blocking the event loop.
+    Each pull waits on the network, so it runs in a worker thread and chunks are sent as they arrive.
+    """
+    chunks = iter(audio_stream)
+    while True:
+        audio_chunk = await asyncio.to_thread(next, chunks, None)
+        if audio_chunk is None:
+            return
+        yield audio_chunk
+
 async def stream_joke_audio(websocket, session_id, joke_data, joke_tts, joke_type="general", original_text="", extra_data=None):
-    """Helper function to stream joke audio chunks to client"""
+    """
+    Helper function to stream joke audio chunks to client. Returns False if TTS
+    failed before the joke_response header went out, so the caller can still
+    send the joke as text; failures after the header are re-raised instead,
+    since the client already has the joke.
+    """
+    header_sent = False
     try:
         # Get audio stream generator for low latency
         audio_stream = await joke_tts.speak_joke(joke_data, play_audio=False, stream=True)
         if not audio_stream:
             return False
 
-        logger.info(f"Starting TTS stream for {joke_type} joke: {joke_data.get('joke_response', '')}")
+        logger.info("Starting TTS stream for %s joke: %s", joke_type, joke_data.get('joke_response', ''))
 
         # Send joke response immediately
         response_data = {
@@ -76,108 +203,124 @@ async def stream_joke_audio(websocket, session_id, joke_data, joke_tts, joke_typ
         if extra_data:
             response_data.update(extra_data)
 
-        await websocket.send_json(response_data)
+        await send_message(websocket, response_data)
+        header_sent = True
 
         # Stream audio chunks as they arrive
         chunk_count = 0
-        for audio_chunk in audio_stream:
-            chunk_b64 = base64.b64encode(audio_chunk).decode('utf-8')
-            await websocket.send_json({
-                "type": "joke_audio_chunk",
-                "session_id": session_id,
-                "chunk_data": chunk_b64,
-                "chunk_index": chunk_count,
-                "format": "mp3"
-            })
+        async for audio_chunk in iter_audio_stream(audio_stream):
+            await send_audio_chunk(websocket, _FRAME_JOKE_AUDIO_CHUNK, chunk_count, audio_chunk)
             chunk_count += 1
 
         # Send end marker
-        await websocket.send_json({
+        await send_message(websocket, {
             "type": "joke_audio_end",
             "session_id": session_id,
             "total_chunks": chunk_count
         })
 
-        logger.info(f"Completed TTS stream for {joke_type}: {chunk_count} chunks sent")
+        logger.info("Completed TTS stream for %s: %s chunks sent", joke_type, chunk_count)
         return True
 
     except Exception as e:
-        logger.error(f"Error streaming joke audio: {e}")
+        if header_sent:
+            raise
+        logger.error("Error streaming joke audio: %s", e)
         return False
 
-async def check_sleeper_phrases(text: str) -> tuple[bool, str, str]:
+# Sassy replies per sleeper phrase type
+_ACTIVATE_RESPONSES = (
+    "Oh, NOW you want to hear from me? Fine, I'm back to being your personal comedian.",
+    "Well well well, look who's crawling back for my jokes! I suppose I can grace you with my presence again.",
+    "Alright alright, you twisted my arm. Time to unleash my comedic genius on you again!",
+    "You missed me, didn't you? Of course you did. Nobody delivers punchlines like me!",
+    "Back in business! Hope you're ready for some premium quality humor coming your way.",
+)
+
+_CONVERSATION_MODE_RESPONSES = (
+    "Conversation mode activated! Now I'll chat about literally everything. Hope you're ready for my hot takes!",
+    "Alright, switching to conversation mode! I'm about to become your most talkative companion.",
+    "Conversation mode ON! Time for me to comment on absolutely everything you say. You asked for it!",
+    "Now we're talking! Conversation mode means I'll never shut up. You've been warned!",
+    "Conversation mode engaged! Hope you like hearing my voice because it's about to be constant commentary.",
+)
+
+_COMMENT_MODE_RESPONSES = (
+    "Comment mode activated! Now I'll only speak when I have something REALLY good to say. Quality over quantity!",
+    "Switching to selective mode! I'll only grace you with my wit when it's truly worth it.",
+    "Comment mode ON! I'm going back to being picky about when to share my comedic genius.",
+    "Fine, I'll be more selective with my pearls of wisdom. Only the premium content from now on!",
+    "Comment mode engaged! I'll save my energy for the moments that truly deserve my attention.",
+)
+
+_DEACTIVATE_RESPONSES = (
+    "Rude! But fine, I'll zip it. Don't come crying to me when you're bored out of your mind.",
+    "Oh, so NOW I'm too much for you? Whatever, I'll just sit here in silence... dramatically.",
+    "Wow, okay. I see how it is. I'll be over here NOT making you laugh if you need me.",
+    "Your loss! I was just getting warmed up with my A-material. Going into stealth mode now.",
+    "Fine, fine. I'll go back to my corner. But just so you know, the silence will be DEAFENING.",
+)
+
+_STOP_MUSIC_RESPONSES = (
+    "Fine, cutting off the tunes. Back to jokes it is!",
+    "Alright alright, killing the music. Hope you're ready for my comedy stylings instead!",
+    "Music's dead, long live the jokes! What can I say that's funny now?",
+    "Boom, silence achieved. Now let me fill that void with some quality humor.",
+    "Music stopped! Don't worry, I've got plenty of audio entertainment for you right here.",
+)
+
+_VANITY_RESPONSES = (
+    "You're a hackathon goblin. No charm, just pure basement-dweller energy.",
+    "Pretty? You haven't showered in 48 hours. You're serving 'failed startup founder' realness.",
+    "You look like the human embodiment of a memory leak. And not the good kind.",
+    "Fashion police would arrest you on sight. I'd testify against you.",
+    "Beauty is in the eye of the beholder? My sensors are malfunctioning from your stench.",
+    "I can tell you haven't seen sunlight in 48 hours. Consider touching some grass.",
+)
+
+async def check_sleeper_phrases(text: str, state: SessionState) -> tuple[bool, str, str]:
     """
-    Check if the text contains sleeper agent phrases and update streaming state.
+    Check if the text contains sleeper agent phrases and update the session's streaming state.
     Returns (is_sleeper_phrase, sassy_response, phrase_type).
     """
-    global streaming_enabled, conversation_mode
 
-    # Handle both partial and final transcripts
-    import re
-    text_clean = text.replace("[partial]", "").strip()
-    # Remove punctuation and make lowercase
-    text_clean = re.sub(r'[^\w\s]', '', text_clean).lower().strip()
+    # Handle both partial and final transcripts: drop the partial marker and punctuation in one pass.
+    # Case is handled by the phrase pattern itself.
+    text_clean = _SLEEPER_STRIP_RE.sub("", text)
 
-    logger.debug(f"Checking sleeper phrases in: '{text}' -> cleaned: '{text_clean}'")
+    logger.debug("Checking sleeper phrases in: '%s' -> cleaned: '%s'", text, text_clean)
+
+    found = {match.lastgroup for match in _SLEEPER_PHRASE_RE.finditer(text_clean)}
+    if not found:
+        return False, "", ""
+    phrase_type = next(t for t in _SLEEPER_PRIORITY if t in found)
 
     # Check for activation phrase
-    if "talk to me" in text_clean or "talk to polly" in text_clean:
-        streaming_enabled = True
+    if phrase_type == "activate":
+        state.streaming_enabled = True
         logger.info("Sleeper agent activated: Audio streaming enabled")
-        sassy_responses = [
-            "Oh, NOW you want to hear from me? Fine, I'm back to being your personal comedian.",
-            "Well well well, look who's crawling back for my jokes! I suppose I can grace you with my presence again.",
-            "Alright alright, you twisted my arm. Time to unleash my comedic genius on you again!",
-            "You missed me, didn't you? Of course you did. Nobody delivers punchlines like me!",
-            "Back in business! Hope you're ready for some premium quality humor coming your way."
-        ]
-        import random
-        return True, random.choice(sassy_responses), "activate"
+        return True, random.choice(_ACTIVATE_RESPONSES), "activate"
 
     # Check for conversation mode toggle
-    if "conversation mode polly" in text_clean or "conversation mode" in text_clean:
-        conversation_mode = True
+    if phrase_type == "conversation_mode":
+        state.conversation_mode = True
         logger.info("Polly switched to conversation mode: Will always reply")
-        sassy_responses = [
-            "Conversation mode activated! Now I'll chat about literally everything. Hope you're ready for my hot takes!",
-            "Alright, switching to conversation mode! I'm about to become your most talkative companion.",
-            "Conversation mode ON! Time for me to comment on absolutely everything you say. You asked for it!",
-            "Now we're talking! Conversation mode means I'll never shut up. You've been warned!",
-            "Conversation mode engaged! Hope you like hearing my voice because it's about to be constant commentary."
-        ]
-        import random
-        return True, random.choice(sassy_responses), "conversation_mode"
+        return True, random.choice(_CONVERSATION_MODE_RESPONSES), "conversation_mode"
 
     # Check for comment mode toggle
-    if "comment mode polly" in text_clean or "comment mode" in text_clean:
-        conversation_mode = False
+    if phrase_type == "comment_mode":
+        state.conversation_mode = False
         logger.info("Polly switched to comment mode: Will evaluate whether to reply")
-        sassy_responses = [
-            "Comment mode activated! Now I'll only speak when I have something REALLY good to say. Quality over quantity!",
-            "Switching to selective mode! I'll only grace you with my wit when it's truly worth it.",
-            "Comment mode ON! I'm going back to being picky about when to share my comedic genius.",
-            "Fine, I'll be more selective with my pearls of wisdom. Only the premium content from now on!",
-            "Comment mode engaged! I'll save my energy for the moments that truly deserve my attention."
-        ]
-        import random
-        return True, random.choice(sassy_responses), "comment_mode"
+        return True, random.choice(_COMMENT_MODE_RESPONSES), "comment_mode"
 
     # Check for deactivation phrase
-    if "shut up polly" in text_clean or "shut up" in text_clean:
-        streaming_enabled = False
+    if phrase_type == "deactivate":
+        state.streaming_enabled = False
         logger.info("Sleeper agent deactivated: Audio streaming disabled")
-        sassy_responses = [
-            "Rude! But fine, I'll zip it. Don't come crying to me when you're bored out of your mind.",
-            "Oh, so NOW I'm too much for you? Whatever, I'll just sit here in silence... dramatically.",
-            "Wow, okay. I see how it is. I'll be over here NOT making you laugh if you need me.",
-            "Your loss! I was just getting warmed up with my A-material. Going into stealth mode now.",
-            "Fine, fine. I'll go back to my corner. But just so you know, the silence will be DEAFENING."
-        ]
-        import random
-        return True, random.choice(sassy_responses), "deactivate"
+        return True, random.choice(_DEACTIVATE_RESPONSES), "deactivate"
 
     # Check for music stop phrase
-    if "stop music polly" in text_clean or "stop music" in text_clean or "stop the music" in text_clean:
+    if phrase_type == "stop_music":
         logger.info("Music stop command detected")
         
         # Stop any playing music
@@ -185,488 +328,551 @@ async def check_sleeper_phrases(text: str) -> tuple[bool, str, str]:
             try:
                 await music_controller.stop_playback()
             except Exception as e:
-                logger.error(f"Error stopping music: {e}")
+                logger.error("Error stopping music: %s", e)
         
-        sassy_responses = [
-            "Fine, cutting off the tunes. Back to jokes it is!",
-            "Alright alright, killing the music. Hope you're ready for my comedy stylings instead!",
-            "Music's dead, long live the jokes! What can I say that's funny now?",
-            "Boom, silence achieved. Now let me fill that void with some quality humor.",
-            "Music stopped! Don't worry, I've got plenty of audio entertainment for you right here."
-        ]
-        import random
-        return True, random.choice(sassy_responses), "stop_music"
-
-    if (
-        "what do you think of me" in text_clean
-        or "how do i look today" in text_clean
-        or "am i pretty today" in text_clean
-        or "do i look good" in text_clean
-    ):
+        return True, random.choice(_STOP_MUSIC_RESPONSES), "stop_music"
+
+    if phrase_type == "vanity_check":
         logger.info("Vanity sleeper phrase detected")
 
-        sassy_responses = [
-            "You're a hackathon goblin. No charm, just pure basement-dweller energy.",
-            "Pretty? You haven't showered in 48 hours. You're serving 'failed startup founder' realness.",
-            "You look like the human embodiment of a memory leak. And not the good kind.",
-            "Fashion police would arrest you on sight. I'd testify against you.",
-            "Beauty is in the eye of the beholder? My sensors are malfunctioning from your stench.",
-            "I can tell you haven't seen sunlight in 48 hours. Consider touching some grass."
-        ]
-        import random
-        return True, random.choice(sassy_responses), "vanity_check"
+        return True, random.choice(_VANITY_RESPONSES), "vanity_check"
 
     return False, "", ""
 
-# Initialize joke TTS (optional - only if ElevenLabs API key is available)
-joke_tts = None
-try:
-    joke_tts = JokeTTS()
-    logger.info("JokeTTS initialized successfully")
-except Exception as e:
-    logger.warning(f"JokeTTS not available: {e}")
+def claim_audio_stream(session_id):
+    """Mark the session as streaming TTS audio. Returns False if another task already is."""
+    if audio_currently_streaming.get(session_id, False):
+        return False
+    audio_currently_streaming[session_id] = True
+    return True
+
+async def handle_transcription(websocket, session_id, state, transcription, timestamp, semaphore):
+    """
+    Respond to a final transcript: sleeper phrases, music requests, then jokes with TTS.
+    Runs as a background task so the receive loop keeps draining audio while the LLM and TTS calls are in flight.
+    """
+    joke_tts = get_joke_tts()
+    async with semaphore:
+        try:
+            logger.debug("Processing transcription for %s: '%s'", session_id, transcription)
+
+            # Check for sleeper phrases first
+            sleeper_phrase_detected, sassy_response, phrase_type = await check_sleeper_phrases(transcription, state)
+
+            logger.debug("Sleeper phrase check result for %s: detected=%s, type='%s', response='%s'",
+                         session_id, sleeper_phrase_detected, phrase_type, sassy_response)
+
+            # Handle sleeper phrases first (before checking streaming enabled)
+            if sleeper_phrase_detected:
+                sleeper_message = {
+                    "type": "sleeper_phrase",
+                    "session_id": session_id,
+                    "transcription": transcription,
+                    "streaming_enabled": state.streaming_enabled,
+                    "sassy_response": sassy_response,
+                    "phrase_type": phrase_type,
+                    "timestamp": timestamp
+                }
+                streamed = False
+
+                # Generate TTS for the sassy response if available
+                if joke_tts and sassy_response and claim_audio_stream(session_id):
+                    try:
+                        logger.info("Converting sassy response to speech for %s", session_id)
+                        # Create a fake joke result structure for TTS
+                        fake_joke_result = {
+                            "joke_response": sassy_response,
+                            "joke_type": "sleeper_acknowledgment",
+                            "confidence": 1.0
+                        }
+                        # Use streaming helper for low latency; the acknowledgment
+                        # rides on the same frame as the streamed joke_response
+                        extra_data = {
+                            "sleeper_phrase": True,
+                            "joke": sassy_response,
+                            "transcription": transcription,
+                            "streaming_enabled": state.streaming_enabled,
+                            "sassy_response": sassy_response,
+                            "phrase_type": phrase_type,
+                            "timestamp": timestamp
+                        }
+
+                        streamed = await stream_joke_audio(
+                            websocket, session_id, fake_joke_result, joke_tts,
+                            joke_type="sleeper_acknowledgment",
+                            original_text=transcription,
+                            extra_data=extra_data
+                        )
+
+                        logger.info("Sassy response audio streamed for %s", session_id)
+                    except Exception as e:
+                        # Raised only after the acknowledgment header went out, so don't resend it
+                        streamed = True
+                        logger.error("Error generating sassy response audio for %s: %s", session_id, e)
+                    finally:
+                        # Clear streaming state
+                        audio_currently_streaming[session_id] = False
+
+                # Send sleeper phrase acknowledgment on its own only when no audio went out
+                if not streamed:
+                    await send_message(websocket, sleeper_message)
+
+                return  # Skip joke processing for sleeper phrases
+
+            # Only process jokes if streaming is enabled
+            if not state.streaming_enabled:
+                # Just send back the transcription without processing
+                await send_transcription(websocket, session_id, transcription, timestamp, _STREAMING_DISABLED_FIELD)
+                return
+
+            # Check if audio is currently being streamed for this session
+            if audio_currently_streaming.get(session_id, False):
+                logger.info("Audio already streaming for %s, skipping new audio generation", session_id)
+                # Just send back the transcription
+                await send_transcription(websocket, session_id, transcription, timestamp, _AUDIO_BUSY_FIELD)
+                return
+
+            # Check if this is a music request first (before jokes)
+            # Only process music requests on final transcripts (not partials) to prevent race conditions
+            music_result = None
+            if music_responder and music_controller and not transcription.startswith("[partial]"):
+                try:
+                    music_request = await music_responder.process_transcription(transcription)
+                    if music_request:
+                        logger.info("Processing music request for %s: %s", session_id, music_request)
+
+                        # First, search for the music but don't play it yet
+                        music_result = await music_controller.search_and_play(music_request)
+
+                        if music_result and music_result.get("success", False):
+                            # Step 1: Generate and send TTS audio first
+                            if joke_tts and music_result.get("joke_message") and claim_audio_stream(session_id):
+                                try:
+                                    logger.info("Converting music message to speech for %s", session_id)
+
+                                    # Create fake joke result for TTS
+                                    fake_joke_result = {
+                                        "joke_response": music_result.get("joke_message"),
+                                        "joke_type": "music_response",
+                                        "confidence": 1.0
+                                    }
+
+                                    # Use streaming helper for low latency
+                                    extra_data = {
+                                        "music_request": True,
+                                        "timestamp": timestamp
+                                    }
+
+                                    await stream_joke_audio(
+                                        websocket, session_id, fake_joke_result, joke_tts,
+                                        joke_type="music_response",
+                                        original_text=transcription,
+                                        extra_data=extra_data
+                                    )
+
+                                    logger.info("Music TTS audio streamed for %s", session_id)
+
+                                except Exception as e:
+                                    logger.error("Error generating music TTS for %s: %s", session_id, e)
+                                finally:
+                                    # Clear streaming state
+                                    audio_currently_streaming[session_id] = False
+
+                                    # Step 2: Start music playback after TTS is complete
+                                    if music_result.get("track_info"):
+                                        try:
+                                            playback_result = await music_controller.start_playback(music_result["track_info"])
+                                            if playback_result["success"]:
+                                                logger.info("Music playback started successfully for %s", session_id)
+                                            else:
+                                                logger.error("Failed to start music playback: %s", playback_result.get('error'))
+                                        except Exception as e:
+                                            logger.error("Error starting music playback: %s", e)
+                        else:
+                            # Send failed music response
+                            await send_message(websocket, {
+                                "type": "music_response",
+                                "session_id": session_id,
+                                "original_text": transcription,
+                                "music_request": music_request,
+                                "music_result": music_result or {"success": False, "error": "Search failed"},
+                                "timestamp": timestamp
+                            })
+
+                except Exception as e:
+                    logger.error("Error processing music request for %s: %s", session_id, e)
+
+            # Only process jokes if no music was requested and on final transcripts
+            joke_result = None
+            if not music_result and not transcription.startswith("[partial]"):
+                # Get recent expression data for context
+                current_expression = expression_cache.get(session_id)
+                # Show the joke text as it is generated; TTS still starts from the finished joke
+                on_delta = joke_delta_sender(functools.partial(send_message, websocket), session_id=session_id)
+                joke_result = await get_joke_responder().process_text_for_joke(
+                    transcription, current_expression, state.conversation_mode, on_delta=on_delta
+                )
+
+            if joke_result:
+                logger.info("Generated joke for %s: %s", session_id, joke_result['joke_response'])
+
+                joke_message = {
+                    "type": "joke_response",
+                    "session_id": session_id,
+                    "original_text": transcription,
+                    "joke": joke_result["joke_response"],
+                    "joke_type": joke_result["joke_type"],
+                    "confidence": joke_result["confidence"],
+                    "timestamp": timestamp
+                }
+                streamed = False
+
+                # Generate TTS audio if available
+                if joke_tts and claim_audio_stream(session_id):
+                    try:
+                        logger.info("Converting joke to speech for %s", session_id)
+                        # Use streaming helper for low latency; the joke text
+                        # rides on the same frame as the streamed joke_response
+                        extra_data = {
+                            "joke": joke_result["joke_response"],
+                            "confidence": joke_result["confidence"],
+                            "timestamp": timestamp
+                        }
+
+                        streamed = await stream_joke_audio(
+                            websocket, session_id, joke_result, joke_tts,
+                            joke_type=joke_result.get("joke_type", "general"),
+                            original_text=transcription,
+                            extra_data=extra_data
+                        )
+
+                        logger.info("Joke audio streamed for %s", session_id)
+                    except Exception as e:
+                        # Raised only after the joke_response header went out; joke_tts_failed
+                        # below carries the text, so the joke must not be sent again
+                        streamed = True
+                        logger.error("Error generating joke audio for %s: %s", session_id, e)
+                        # Send joke without audio when TTS fails
+                        await send_message(websocket, {
+                            "type": "joke_tts_failed",
+                            "session_id": session_id,
+                            "message": "Audio generation failed, but joke is still available",
+                            "joke_text": joke_result["joke_response"],
+                            "timestamp": timestamp
+                        })
+                    finally:
+                        # Clear streaming state
+                        audio_currently_streaming[session_id] = False
+
+                # Send joke response on its own only when no audio went out
+                if not streamed:
+                    await send_message(websocket, joke_message)
+            else:
+                # Send transcription back if no joke or music was generated
+                # Always send transcriptions (including partials) for real-time feedback
+                if not music_result:
+                    await send_transcription(websocket, session_id, transcription, timestamp)
+        except Exception as e:
+            logger.error("Error handling transcription for %s: %s", session_id, e)
 
 # Define a simple route
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Hello, FastAPI with Audio Processing!"}
 
 @app.get("/items/{item_id}")
-def read_item(item_id: int, q: str | None = None):
+async def read_item(item_id: int, q: str | None = None):
     return {"item_id": item_id, "q": q}
 
 @app.get("/streaming-status")
-def get_streaming_status():
-    return {"streaming_enabled": streaming_enabled}
+async def get_streaming_status(session_id: str | None = None):
+    state = session_states.get(session_id, _DEFAULT_SESSION_STATE)
+    return {"streaming_enabled": state.streaming_enabled}
 
 @app.get("/polly-status")
-def get_polly_status():
+async def get_polly_status(session_id: str | None = None):
+    state = session_states.get(session_id, _DEFAULT_SESSION_STATE)
     return {
-        "streaming_enabled": streaming_enabled,
-        "conversation_mode": conversation_mode
+        "streaming_enabled": state.streaming_enabled,
+        "conversation_mode": state.conversation_mode
     }
 
+@app.on_event("startup")
+async def startup():
+    get_audio_processor()
+    get_joke_responder()
+    get_joke_tts()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_audio_processor().close()
+    await get_joke_responder().close()
+
+async def handle_session_start(websocket, data, session_id):
+    """Register the session and acknowledge it."""
+    session_id = data.get("session_id", websocket.state.default_session_id)
+    await manager.connect(websocket, session_id)
+    session_states[session_id] = SessionState()
+
+    logger.info("Audio session started: %s", session_id)
+    await send_session_reply(websocket, _SESSION_STARTED_PREFIX, session_id)
+    return session_id
+
+async def handle_video_frame(websocket, data, session_id):
+    """Analyze a video frame's facial expression and occasionally answer with a facial joke."""
+    session_id = data.get("session_id", "unknown")
+    frame_data = data.get("frame_data")
+    timestamp = data.get("timestamp")
+
+    if frame_data and expression_analyzer:
+        logger.debug("Processing video frame for %s", session_id)
+
+        try:
+            # Analyze facial expression
+            expression_result = await expression_analyzer.analyze_frame_async(frame_data)
+
+            if expression_result.get("success", False):
+                expression = expression_result["expression"]
+                confidence = expression_result["confidence"]
+                description = expression_analyzer.get_expression_description(expression, confidence)
+                metadata = expression_result.get("metadata", {})
+                logger.debug("Expression detected for %s: %s (confidence: %.2f)", session_id, expression, confidence)
+
+                # Cache expression data for joke generation
+                expression_cache[session_id] = {
+                    "expression": expression,
+                    "confidence": confidence,
+                    "description": description,
+                    "timestamp": timestamp,
+                    "success": True,
+                    "metadata": metadata
+                }
+
+                # Check if we should generate a random facial joke (15% chance)
+                facial_joke = ""
+                facial_joke_audio_data = None
+                if expression_analyzer.should_generate_joke(0.15):
+                    facial_joke = expression_analyzer.generate_facial_joke(expression_result)
+                    if facial_joke:
+                        logger.info("Generated facial joke for %s: %s", session_id, facial_joke)
+
+                        # Convert facial joke to speech if TTS is available
+                        joke_tts = get_joke_tts()
+                        if joke_tts:
+                            try:
+                                # Get audio stream generator for low latency
+                                audio_stream = await joke_tts.speak_text(facial_joke, play_audio=False, stream=True)
+                                if audio_stream:
+                                    logger.info("Starting TTS stream for facial joke: %s", facial_joke)
+
+                                    # Send response immediately with joke text
+                                    response_data = {
+                                        "type": "expression_result",
+                                        "session_id": session_id,
+                                        "expression": expression,
+                                        "confidence": confidence,
+                                        "emoji": expression_analyzer.get_expression_emoji(expression),
+                                        "description": description,
+                                        "face_detected": expression_result.get("face_detected", False),
+                                        "timestamp": timestamp,
+                                        "metadata": metadata,
+                                        "facial_joke": facial_joke,
+                                        "facial_joke_streaming": True
+                                    }
+                                    await send_message(websocket, response_data)
+
+                                    # Stream audio chunks as they arrive
+                                    chunk_count = 0
+                                    async for audio_chunk in iter_audio_stream(audio_stream):
+                                        await send_audio_chunk(websocket, _FRAME_FACIAL_JOKE_AUDIO_CHUNK, chunk_count, audio_chunk)
+                                        chunk_count += 1
+
+                                    # Send end marker
+                                    await send_message(websocket, {
+                                        "type": "facial_joke_audio_end",
+                                        "session_id": session_id,
+                                        "total_chunks": chunk_count
+                                    })
+
+                                    logger.info("Completed TTS stream for facial joke: %s chunks sent", chunk_count)
+                                    # Skip the normal response sending since we already sent it
+                                    return session_id
+                            except Exception as e:
+                                logger.warning("Failed to stream TTS for facial joke: %s", e)
+                                # Fall back to normal processing
+
+                # Send expression result back to client
+                response_data = {
+                    "type": "expression_result",
+                    "session_id": session_id,
+                    "expression": expression,
+                    "confidence": confidence,
+                    "emoji": expression_analyzer.get_expression_emoji(expression),
+                    "description": description,
+                    "face_detected": expression_result.get("face_detected", False),
+                    "timestamp": timestamp,
+                    "metadata": metadata
+                }
+
+                # Add facial joke if generated
+                if facial_joke:
+                    response_data["facial_joke"] = facial_joke
+
+                    # Add audio data if TTS was successful
+                    if facial_joke_audio_data:
+                        response_data["facial_joke_audio"] = facial_joke_audio_data
+                        response_data["facial_joke_audio_format"] = "mp3"
+
+                await send_message(websocket, response_data)
+            else:
+                # Send error/no face detected result
+                expression = expression_result.get("expression", "no_face")
+                await send_message(websocket, {
+                    "type": "expression_result",
+                    "session_id": session_id,
+                    "expression": expression,
+                    "confidence": 0.0,
+                    "emoji": expression_analyzer.get_expression_emoji(expression),
+                    "error": expression_result.get("error", "No face detected"),
+                    "face_detected": False,
+                    "timestamp": timestamp
+                })
+
+        except Exception as e:
+            logger.error("Error processing video frame for %s: %s", session_id, e)
+            await send_message(websocket, {
+                "type": "expression_result",
+                "session_id": session_id,
+                "expression": "error",
+                "confidence": 0.0,
+                "emoji": "❌",
+                "error": str(e),
+                "face_detected": False,
+                "timestamp": timestamp
+            })
+    return session_id
+
+async def handle_audio_chunk(websocket, data, session_id):
+    """Forward a PCM chunk to Deepgram and hand final transcripts to a background task."""
+    session_id = data.get("session_id", "unknown")
+    timestamp = data.get("timestamp")
+    audio_data = data.get("pcm")
+    if audio_data is None:
+        audio_b64 = data.get("audio_data")
+        # JSON clients still send base64-encoded PCM
+        audio_data = b64decode(audio_b64) if audio_b64 else None
+
+    if audio_data:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing audio chunk for %s: %d bytes", session_id, len(audio_data))
+
+        # Process with AudioProcessor
+        transcription = await get_audio_processor().process_audio_chunk(
+            audio_data, session_id
+        )
+
+        if transcription and not transcription.startswith("[partial]"):
+            websocket.state.task_group.start_soon(
+                handle_transcription,
+                websocket, session_id, session_states.setdefault(session_id, SessionState()),
+                transcription, timestamp, websocket.state.transcription_semaphore
+            )
+    return session_id
+
+async def handle_session_end(websocket, data, session_id):
+    """Reset per-session state and acknowledge the end of the session."""
+    session_id = data.get("session_id", "unknown")
+    logger.info("Audio session ended: %s", session_id)
+
+    # Reset audio buffer, streaming state, and expression cache
+    get_audio_processor().reset_buffer()
+    audio_currently_streaming.pop(session_id, None)
+    expression_cache.pop(session_id, None)
+    session_states.pop(session_id, None)
+
+    await send_session_reply(websocket, _SESSION_ENDED_PREFIX, session_id)
+    return session_id
+
+# Client message type -> handler; each takes (websocket, data, session_id) and returns the session id
+_MESSAGE_HANDLERS = {
+    "session_start": handle_session_start,
+    "video_frame": handle_video_frame,
+    "audio_chunk": handle_audio_chunk,
+    "session_end": handle_session_end,
+}
+
 @app.websocket("/ws/audio")
 async def websocket_audio_endpoint(websocket: WebSocket):
     session_id = None
+    # Per-connection state shared with the message handlers. Transcript handlers run as
+    # background tasks; sends from them and the receive loop share one lock.
+    websocket.state.send_lock = anyio.Lock()
+    websocket.state.transcription_semaphore = anyio.Semaphore(2)
 
     try:
         # Accept connection
         await websocket.accept()
         logger.info("Audio WebSocket connection established")
+        # Fallback session id for clients that don't send one; stable for the whole connection
+        websocket.state.default_session_id = f"session_{secrets.token_hex(8)}"
 
-        async for message in websocket.iter_text():
+        # Transcript handlers live in this connection's task group; leaving it cancels any still in flight
+        async with anyio.create_task_group() as task_group:
+            websocket.state.task_group = task_group
             try:
-                data = json.loads(message)
-                msg_type = data.get("type")
-
-                if msg_type == "session_start":
-                    session_id = data.get("session_id", f"session_{id(websocket)}")
-                    await manager.connect(websocket, session_id)
-
-                    logger.info(f"Audio session started: {session_id}")
-                    await websocket.send_json({
-                        "type": "session_started",
-                        "session_id": session_id,
-                        "status": "ready"
-                    })
-
-                elif msg_type == "video_frame":
-                    session_id = data.get("session_id", "unknown")
-                    frame_data = data.get("frame_data")
-
-                    if frame_data and expression_analyzer:
-                        logger.debug(f"Processing video frame for {session_id}")
-
-                        try:
-                            # Analyze facial expression
-                            expression_result = expression_analyzer.analyze_frame(frame_data)
-
-                            if expression_result.get("success", False):
-                                logger.info(f"Expression detected for {session_id}: {expression_result['expression']} (confidence: {expression_result['confidence']:.2f})")
-
-                                # Cache expression data for joke generation
-                                expression_cache[session_id] = {
-                                    "expression": expression_result["expression"],
-                                    "confidence": expression_result["confidence"],
-                                    "description": expression_analyzer.get_expression_description(
-                                        expression_result["expression"],
-                                        expression_result["confidence"]
-                                    ),
-                                    "timestamp": data.get("timestamp"),
-                                    "success": True,
-                                    "metadata": expression_result.get("metadata", {})
-                                }
-
-                                # Check if we should generate a random facial joke (15% chance)
-                                facial_joke = ""
-                                facial_joke_audio_data = None
-                                if expression_analyzer.should_generate_joke(0.15):
-                                    facial_joke = expression_analyzer.generate_facial_joke(expression_result)
-                                    if facial_joke:
-                                        logger.info(f"Generated facial joke for {session_id}: {facial_joke}")
-
-                                        # Convert facial joke to speech if TTS is available
-                                        if joke_tts:
-                                            try:
-                                                # Get audio stream generator for low latency
-                                                audio_stream = await joke_tts.speak_text(facial_joke, play_audio=False, stream=True)
-                                                if audio_stream:
-                                                    logger.info(f"Starting TTS stream for facial joke: {facial_joke}")
-
-                                                    # Send response immediately with joke text
-                                                    response_data = {
-                                                        "type": "expression_result",
-                                                        "session_id": session_id,
-                                                        "expression": expression_result["expression"],
-                                                        "confidence": expression_result["confidence"],
-                                                        "emoji": expression_analyzer.get_expression_emoji(expression_result["expression"]),
-                                                        "description": expression_analyzer.get_expression_description(
-                                                            expression_result["expression"],
-                                                            expression_result["confidence"]
-                                                        ),
-                                                        "face_detected": expression_result.get("face_detected", False),
-                                                        "timestamp": data.get("timestamp"),
-                                                        "metadata": expression_result.get("metadata", {}),
-                                                        "facial_joke": facial_joke,
-                                                        "facial_joke_streaming": True
-                                                    }
-                                                    await websocket.send_json(response_data)
-
-                                                    # Stream audio chunks as they arrive
-                                                    chunk_count = 0
-                                                    for audio_chunk in audio_stream:
-                                                        chunk_b64 = base64.b64encode(audio_chunk).decode('utf-8')
-                                                        await websocket.send_json({
-                                                            "type": "facial_joke_audio_chunk",
-                                                            "session_id": session_id,
-                                                            "chunk_data": chunk_b64,
-                                                            "chunk_index": chunk_count,
-                                                            "format": "mp3"
-                                                        })
-                                                        chunk_count += 1
-
-                                                    # Send end marker
-                                                    await websocket.send_json({
-                                                        "type": "facial_joke_audio_end",
-                                                        "session_id": session_id,
-                                                        "total_chunks": chunk_count
-                                                    })
-
-                                                    logger.info(f"Completed TTS stream for facial joke: {chunk_count} chunks sent")
-                                                    # Skip the normal response sending since we already sent it
-                                                    continue
-                                            except Exception as e:
-                                                logger.warning(f"Failed to stream TTS for facial joke: {e}")
-                                                # Fall back to normal processing
-
-                                # Send expression result back to client
-                                response_data = {
-                                    "type": "expression_result",
-                                    "session_id": session_id,
-                                    "expression": expression_result["expression"],
-                                    "confidence": expression_result["confidence"],
-                                    "emoji": expression_analyzer.get_expression_emoji(expression_result["expression"]),
-                                    "description": expression_analyzer.get_expression_description(
-                                        expression_result["expression"],
-                                        expression_result["confidence"]
-                                    ),
-                                    "face_detected": expression_result.get("face_detected", False),
-                                    "timestamp": data.get("timestamp"),
-                                    "metadata": expression_result.get("metadata", {})
-                                }
-
-                                # Add facial joke if generated
-                                if facial_joke:
-                                    response_data["facial_joke"] = facial_joke
-
-                                    # Add audio data if TTS was successful
-                                    if facial_joke_audio_data:
-                                        response_data["facial_joke_audio"] = facial_joke_audio_data
-                                        response_data["facial_joke_audio_format"] = "mp3"
-
-                                await websocket.send_json(response_data)
-                            else:
-                                # Send error/no face detected result
-                                await websocket.send_json({
-                                    "type": "expression_result",
-                                    "session_id": session_id,
-                                    "expression": expression_result.get("expression", "no_face"),
-                                    "confidence": 0.0,
-                                    "emoji": expression_analyzer.get_expression_emoji(expression_result.get("expression", "no_face")),
-                                    "error": expression_result.get("error", "No face detected"),
-                                    "face_detected": False,
-                                    "timestamp": data.get("timestamp")
-                                })
-
-                        except Exception as e:
-                            logger.error(f"Error processing video frame for {session_id}: {e}")
-                            await websocket.send_json({
-                                "type": "expression_result",
-                                "session_id": session_id,
-                                "expression": "error",
-                                "confidence": 0.0,
-                                "emoji": "❌",
-                                "error": str(e),
-                                "face_detected": False,
-                                "timestamp": data.get("timestamp")
-                            })
-
-                elif msg_type == "audio_chunk":
-                    session_id = data.get("session_id", "unknown")
-                    audio_b64 = data.get("audio_data")
-
-                    if audio_b64:
-                        # Decode audio data
-                        audio_data = base64.b64decode(audio_b64)
-                        logger.debug(f"Processing audio chunk for {session_id}: {len(audio_data)} bytes")
-
-                        # Process with AudioProcessor
-                        transcription = await audio_processor.process_audio_chunk(
-                            audio_data, session_id
-                        )
-
-                        if transcription and not transcription.startswith("[partial]"):
-                            logger.info(f"Processing transcription for {session_id}: '{transcription}'")
-
-                            # Check for sleeper phrases first
-                            sleeper_phrase_detected, sassy_response, phrase_type = await check_sleeper_phrases(transcription)
-
-                            logger.info(f"Sleeper phrase check result for {session_id}: detected={sleeper_phrase_detected}, type='{phrase_type}', response='{sassy_response}'")
-
-                            # Handle sleeper phrases first (before checking streaming enabled)
-                            if sleeper_phrase_detected:
-
-                                # Send sleeper phrase acknowledgment with sassy response
-                                await websocket.send_json({
-                                    "type": "sleeper_phrase",
-                                    "session_id": session_id,
-                                    "transcription": transcription,
-                                    "streaming_enabled": streaming_enabled,
-                                    "sassy_response": sassy_response,
-                                    "phrase_type": phrase_type,
-                                    "timestamp": data.get("timestamp")
-                                })
-
-                                # Generate TTS for the sassy response if available
-                                if joke_tts and sassy_response:
-                                    try:
-                                        # Mark audio as streaming
-                                        audio_currently_streaming[session_id] = True
-                                        logger.info(f"Converting sassy response to speech for {session_id}")
-                                        # Create a fake joke result structure for TTS
-                                        fake_joke_result = {
-                                            "joke_response": sassy_response,
-                                            "joke_type": "sleeper_acknowledgment",
-                                            "confidence": 1.0
-                                        }
-                                        # Use streaming helper for low latency
-                                        extra_data = {
-                                            "sleeper_phrase": True,
-                                            "streaming_enabled": streaming_enabled,
-                                            "timestamp": data.get("timestamp")
-                                        }
-
-                                        await stream_joke_audio(
-                                            websocket, session_id, fake_joke_result, joke_tts,
-                                            joke_type="sleeper_acknowledgment",
-                                            original_text=transcription,
-                                            extra_data=extra_data
-                                        )
-
-                                        logger.info(f"Sassy response audio streamed for {session_id}")
-                                    except Exception as e:
-                                        logger.error(f"Error generating sassy response audio for {session_id}: {e}")
-                                    finally:
-                                        # Clear streaming state
-                                        audio_currently_streaming[session_id] = False
-
-                                continue  # Skip joke processing for sleeper phrases
-
-                            # Only process jokes if streaming is enabled
-                            if not streaming_enabled:
-                                # Just send back the transcription without processing
-                                await websocket.send_json({
-                                    "type": "transcription",
-                                    "session_id": session_id,
-                                    "text": transcription,
-                                    "streaming_disabled": True,
-                                    "timestamp": data.get("timestamp")
-                                })
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        raise WebSocketDisconnect(message.get("code", 1000))
+
+                    try:
+                        raw = message.get("bytes")
+                        if raw is not None:
+                            # Binary frame: raw PCM audio, no base64 or JSON on this path.
+                            # The PCM is a view into the received frame, so no per-chunk copy is made.
+                            tag, timestamp = _BINARY_HEADER.unpack_from(raw)
+                            if tag != _FRAME_AUDIO_CHUNK:
+                                logger.warning("Unknown binary frame type: %s", tag)
                                 continue
-
-                            # Check if audio is currently being streamed for this session
-                            if audio_currently_streaming.get(session_id, False):
-                                logger.info(f"Audio already streaming for {session_id}, skipping new audio generation")
-                                # Just send back the transcription
-                                await websocket.send_json({
-                                    "type": "transcription",
-                                    "session_id": session_id,
-                                    "text": transcription,
-                                    "audio_busy": True,
-                                    "timestamp": data.get("timestamp")
-                                })
-                                continue
-
-                            # Check if this is a music request first (before jokes)
-                            # Only process music requests on final transcripts (not partials) to prevent race conditions
-                            music_result = None
-                            if music_responder and music_controller and not transcription.startswith("[partial]"):
-                                try:
-                                    music_request = await music_responder.process_transcription(transcription)
-                                    if music_request:
-                                        logger.info(f"Processing music request for {session_id}: {music_request}")
-
-                                        # First, search for the music but don't play it yet
-                                        music_result = await music_controller.search_and_play(music_request)
-
-                                        if music_result and music_result.get("success", False):
-                                            # Step 1: Generate and send TTS audio first
-                                            if joke_tts and music_result.get("joke_message"):
-                                                try:
-                                                    # Mark audio as streaming
-                                                    audio_currently_streaming[session_id] = True
-                                                    logger.info(f"Converting music message to speech for {session_id}")
-
-                                                    # Create fake joke result for TTS
-                                                    fake_joke_result = {
-                                                        "joke_response": music_result.get("joke_message"),
-                                                        "joke_type": "music_response",
-                                                        "confidence": 1.0
-                                                    }
-
-                                                    # Use streaming helper for low latency
-                                                    extra_data = {
-                                                        "music_request": True,
-                                                        "timestamp": data.get("timestamp")
-                                                    }
-
-                                                    await stream_joke_audio(
-                                                        websocket, session_id, fake_joke_result, joke_tts,
-                                                        joke_type="music_response",
-                                                        original_text=transcription,
-                                                        extra_data=extra_data
-                                                    )
-
-                                                    logger.info(f"Music TTS audio streamed for {session_id}")
-
-                                                except Exception as e:
-                                                    logger.error(f"Error generating music TTS for {session_id}: {e}")
-                                                finally:
-                                                    # Clear streaming state
-                                                    audio_currently_streaming[session_id] = False
-                                                    
-                                                    # Step 2: Start music playback after TTS is complete
-                                                    if music_result.get("track_info"):
-                                                        try:
-                                                            playback_result = await music_controller.start_playback(music_result["track_info"])
-                                                            if playback_result["success"]:
-                                                                logger.info(f"Music playback started successfully for {session_id}")
-                                                            else:
-                                                                logger.error(f"Failed to start music playback: {playback_result.get('error')}")
-                                                        except Exception as e:
-                                                            logger.error(f"Error starting music playback: {e}")
-                                        else:
-                                            # Send failed music response
-                                            await websocket.send_json({
-                                                "type": "music_response",
-                                                "session_id": session_id,
-                                                "original_text": transcription,
-                                                "music_request": music_request,
-                                                "music_result": music_result or {"success": False, "error": "Search failed"},
-                                                "timestamp": data.get("timestamp")
-                                            })
-
-                                except Exception as e:
-                                    logger.error(f"Error processing music request for {session_id}: {e}")
-
-                            # Only process jokes if no music was requested and on final transcripts
-                            joke_result = None
-                            if not music_result and not transcription.startswith("[partial]"):
-                                # Get recent expression data for context
-                                current_expression = expression_cache.get(session_id)
-                                joke_result = await joke_responder.process_text_for_joke(transcription, current_expression, conversation_mode)
-
-                            if joke_result:
-                                logger.info(f"Generated joke for {session_id}: {joke_result['joke_response']}")
-
-                                # Send joke response back
-                                await websocket.send_json({
-                                    "type": "joke_response",
-                                    "session_id": session_id,
-                                    "original_text": transcription,
-                                    "joke": joke_result["joke_response"],
-                                    "joke_type": joke_result["joke_type"],
-                                    "confidence": joke_result["confidence"],
-                                    "timestamp": data.get("timestamp")
-                                })
-
-                                # Generate TTS audio if available
-                                if joke_tts:
-                                    try:
-                                        # Mark audio as streaming
-                                        audio_currently_streaming[session_id] = True
-                                        logger.info(f"Converting joke to speech for {session_id}")
-                                        # Use streaming helper for low latency
-                                        extra_data = {
-                                            "timestamp": data.get("timestamp")
-                                        }
-
-                                        await stream_joke_audio(
-                                            websocket, session_id, joke_result, joke_tts,
-                                            joke_type=joke_result.get("joke_type", "general"),
-                                            original_text=transcription,
-                                            extra_data=extra_data
-                                        )
-
-                                        logger.info(f"Joke audio streamed for {session_id}")
-                                    except Exception as e:
-                                        logger.error(f"Error generating joke audio for {session_id}: {e}")
-                                        # Send joke without audio when TTS fails
-                                        await websocket.send_json({
-                                            "type": "joke_tts_failed",
-                                            "session_id": session_id,
-                                            "message": "Audio generation failed, but joke is still available",
-                                            "joke_text": joke_result["joke_response"],
-                                            "timestamp": data.get("timestamp")
-                                        })
-                                    finally:
-                                        # Clear streaming state
-                                        audio_currently_streaming[session_id] = False
-                            else:
-                                # Send transcription back if no joke or music was generated
-                                # Always send transcriptions (including partials) for real-time feedback
-                                if not music_result:
-                                    await websocket.send_json({
-                                        "type": "transcription",
-                                        "session_id": session_id,
-                                        "text": transcription,
-                                        "timestamp": data.get("timestamp")
-                                    })
-
-                elif msg_type == "session_end":
-                    session_id = data.get("session_id", "unknown")
-                    logger.info(f"Audio session ended: {session_id}")
-
-                    # Reset audio buffer, streaming state, and expression cache
-                    audio_processor.reset_buffer()
-                    audio_currently_streaming.pop(session_id, None)
-                    expression_cache.pop(session_id, None)
-
-                    await websocket.send_json({
-                        "type": "session_ended",
-                        "session_id": session_id
-                    })
-
-            except json.JSONDecodeError:
-                logger.error("Invalid JSON received in audio WebSocket")
-            except Exception as e:
-                logger.error(f"Error processing audio message: {e}")
-
-    except WebSocketDisconnect:
-        logger.info(f"Audio WebSocket disconnected for session: {session_id}")
-        if session_id:
-            manager.disconnect(websocket, session_id)
+                            data = {
+                                "type": "audio_chunk",
+                                "session_id": session_id or "unknown",
+                                "timestamp": int(timestamp),
+                                "pcm": memoryview(raw)[_BINARY_HEADER.size:]
+                            }
+                        else:
+                            data = orjson.loads(message["text"])
+
+                        handler = _MESSAGE_HANDLERS.get(data.get("type"))
+                        if handler is not None:
+                            session_id = await handler(websocket, data, session_id)
+
+                    except orjson.JSONDecodeError:
+                        logger.error("Invalid JSON received in audio WebSocket")
+                    except Exception as e:
+                        logger.error("Error processing audio message: %s", e)
+
+            except WebSocketDisconnect:
+                logger.info("Audio WebSocket disconnected for session: %s", session_id)
+                if session_id:
+                    manager.disconnect(websocket, session_id)
+                    session_states.pop(session_id, None)
+            finally:
+                task_group.cancel_scope.cancel()
     except Exception as e:
-        logger.error(f"Audio WebSocket error: {e}")
-
+        logger.error("Audio WebSocket error: %s", e)
+
+if __name__ == "__main__":
+    import os
+    import uvicorn
+
+    # Audio travels as binary frames that are already compressed (MP3) or compress poorly (PCM),
+    # so permessage-deflate would only burn CPU; control messages are too small to benefit
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        ws="websockets",
+        ws_per_message_deflate=False,
+        loop="auto",
+    )
@@ -1,6 +1,8 @@
 from fastapi import WebSocket
+from starlette.websockets import WebSocketState
 from typing import List, Dict
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -10,7 +12,9 @@ class ConnectionManager:
         self.user_sessions: Dict[str, Dict] = {}
 
     async def connect(self, websocket: WebSocket, session_id: str):
-        await websocket.accept()
+        # The endpoint may already have accepted the socket; a second accept raises
+        if websocket.client_state == WebSocketState.CONNECTING:
+            await websocket.accept()
         self.active_connections.append(websocket)
         self.user_sessions[session_id] = {
             "websocket": websocket,
@@ -34,7 +38,7 @@ class ConnectionManager:
     async def send_json_message(self, data: dict, session_id: str):
         if session_id in self.user_sessions:
             websocket = self.user_sessions[session_id]["websocket"]
-            await websocket.send_json(data)
+            await websocket.send_text(orjson.dumps(data).decode('utf-8'))
 
     async def broadcast(self, message: str):
         for connection in self.active_connections:
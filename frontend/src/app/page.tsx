@@ -3,6 +3,15 @@
 import { useEffect, useRef, useState } from 'react'
 import { getWebSocketUrl } from '../config/websocket'
 
+// Binary audio frames: 1-byte type tag + little-endian float64 timestamp, then PCM16 samples
+const AUDIO_CHUNK_FRAME_TAG = 0x01
+const AUDIO_FRAME_HEADER_SIZE = 9
+
+// Binary TTS frames from the server: 1-byte type tag + little-endian uint32 chunk index, then MP3 bytes
+const JOKE_AUDIO_CHUNK_FRAME_TAG = 0x02
+const FACIAL_JOKE_AUDIO_CHUNK_FRAME_TAG = 0x03
+const TTS_FRAME_HEADER_SIZE = 5
+
 export default function Home() {
   const videoRef = useRef<HTMLVideoElement>(null)
   const canvasRef = useRef<HTMLCanvasElement>(null)
@@ -168,6 +177,7 @@ export default function Home() {
         // Connect WebSocket
         const sessionId = `session_${Date.now()}`
         const ws = new WebSocket(getWebSocketUrl('/ws/audio'))
+        ws.binaryType = 'arraybuffer'
         wsRef.current = ws
 
         ws.onopen = () => {
@@ -184,6 +194,31 @@ export default function Home() {
         }
 
         ws.onmessage = (event) => {
+          if (event.data instanceof ArrayBuffer) {
+            // Binary frame: streamed TTS audio chunk for the current joke
+            const header = new DataView(event.data)
+            const tag = header.getUint8(0)
+            if (tag !== JOKE_AUDIO_CHUNK_FRAME_TAG && tag !== FACIAL_JOKE_AUDIO_CHUNK_FRAME_TAG) {
+              console.warn('Unknown binary frame type:', tag)
+              return
+            }
+            const chunkIndex = header.getUint32(1, true)
+            const chunkBytes = new Uint8Array(event.data, TTS_FRAME_HEADER_SIZE)
+
+            if (!streamingAudioRef.current) {
+              // Emergency fallback: set up streaming ref if missing
+              streamingAudioRef.current = {
+                chunks: [],
+                sessionId: sessionId,
+                type: tag === FACIAL_JOKE_AUDIO_CHUNK_FRAME_TAG ? 'facial_joke' : 'joke'
+              }
+              console.log('Emergency: Created streamingAudioRef for session:', sessionId)
+            }
+            streamingAudioRef.current.chunks.push(chunkBytes)
+            console.log(`Received audio chunk ${chunkIndex}: ${chunkBytes.length} bytes (total chunks: ${streamingAudioRef.current.chunks.length})`)
+            return
+          }
+
           try {
             const data = JSON.parse(event.data)
             console.log('Received message:', data.type, data)
@@ -193,6 +228,9 @@ export default function Home() {
             } else if (data.type === 'joke_response') {
               setJokeResponse(data.joke || '')
               setTranscription(data.original_text || '')
+            } else if (data.type === 'joke_delta') {
+              // Pieces of a joke as it is generated; offset 0 starts a new one
+              setJokeResponse(prev => prev.slice(0, data.offset) + data.delta)
             } else if (data.type === 'music_response') {
               setJokeResponse(data.joke_message || '')
               setTranscription(data.original_text || '')
@@ -362,41 +400,6 @@ export default function Home() {
               }
               console.log('Started collecting joke audio chunks')
 
-            } else if (data.type === 'joke_audio_chunk' || data.type === 'facial_joke_audio_chunk') {
-              // Handle streaming audio chunks
-              console.log('Processing audio chunk, streamingAudioRef status:', streamingAudioRef.current)
-
-              if (streamingAudioRef.current && streamingAudioRef.current.sessionId === data.session_id) {
-                try {
-                  const chunkData = atob(data.chunk_data)
-                  const chunkBytes = new Uint8Array(chunkData.length)
-                  for (let i = 0; i < chunkData.length; i++) {
-                    chunkBytes[i] = chunkData.charCodeAt(i)
-                  }
-
-                  streamingAudioRef.current.chunks.push(chunkBytes)
-                  console.log(`Received audio chunk ${data.chunk_index}: ${chunkBytes.length} bytes (total chunks: ${streamingAudioRef.current.chunks.length})`)
-                } catch (e) {
-                  console.error('Error processing audio chunk:', e)
-                }
-              } else {
-                console.warn('Received audio chunk but streamingAudioRef not set up:', {
-                  hasStreamingRef: !!streamingAudioRef.current,
-                  expectedSession: streamingAudioRef.current?.sessionId,
-                  receivedSession: data.session_id
-                })
-
-                // Emergency fallback: set up streaming ref if missing
-                if (!streamingAudioRef.current) {
-                  streamingAudioRef.current = {
-                    chunks: [],
-                    sessionId: data.session_id,
-                    type: 'joke'
-                  }
-                  console.log('Emergency: Created streamingAudioRef for session:', data.session_id)
-                }
-              }
-
             } else if (data.type === 'joke_audio_end' || data.type === 'facial_joke_audio_end') {
               // Audio streaming complete - play combined chunks
               if (streamingAudioRef.current && streamingAudioRef.current.sessionId === data.session_id) {
@@ -432,14 +435,13 @@ export default function Home() {
               int16Data[i] = clampedValue * 32767
             }
 
-            // Send to backend
-            const audioData = btoa(String.fromCharCode(...new Uint8Array(int16Data.buffer)))
-            ws.send(JSON.stringify({
-              type: 'audio_chunk',
-              session_id: sessionId,
-              audio_data: audioData,
-              timestamp: Date.now()
-            }))
+            // Send to backend as a binary frame: type tag + timestamp header, then raw PCM
+            const frame = new Uint8Array(AUDIO_FRAME_HEADER_SIZE + int16Data.byteLength)
+            const header = new DataView(frame.buffer)
+            header.setUint8(0, AUDIO_CHUNK_FRAME_TAG)
+            header.setFloat64(1, Date.now(), true)
+            frame.set(new Uint8Array(int16Data.buffer), AUDIO_FRAME_HEADER_SIZE)
+            ws.send(frame)
           }
         }
 